@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Validate and time the TNSR agent's batched RESTCONF apply against the fake RESTCONF server.
+
+The poller writes the configs of --spokes new spokes to the stubbed bucket and
+the agent applies them to benchmark/fake_restconf.py, once per apply mode.
+With --fail the route of one spoke is rejected by the server; the run must
+then leave no part of that tunnel behind while every other tunnel is built.
+
+    python benchmark/bench_agent_apply.py --spokes 120 --fail
+"""
+
+import argparse
+import contextlib
+import io
+import shutil
+import sys
+import tempfile
+import time
+
+import stubs
+from fake_restconf import FakeRestconf
+
+sys.path.insert(0, stubs.ROOT)
+import transitvpc_ipsec as agent
+
+
+def checkConsistent(store):
+  """Every tunnel on the server is complete: ipip, ipsec, interface and a route through it."""
+  data = store.data
+  routed = set(hop['if-name'] for route in data['routes'].values() for hop in route['next-hop']['hop'])
+  for instance in set(data['ipip']) | set(data['ipsec']):
+    name = 'ipsec{0}'.format(instance)
+    if instance not in data['ipip'] or instance not in data['ipsec'] or name not in data['interfaces'] or name not in routed:
+      return False
+  return True
+
+
+def run(spokes, mode, fail):
+  aws = stubs.FakeAWS(['us-east-1'])
+  aws.addSpokes(spokes)
+  stubs.runPoller(stubs.attachPoller(aws, spokes))
+
+  server = FakeRestconf(yang_patch=mode == 'yang-patch').start()
+  if fail:
+    # Reject the route of the first spoke
+    server.store.fail.add(agent.routePath(aws.vpcs[sorted(aws.vpcs)[0]]['CidrBlock']))
+  cache_dir = tempfile.mkdtemp()
+  stubs.attachAgent(aws, server, cache_dir)
+  agent.apply_mode = mode
+  try:
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+      agent.createIPSec()
+    elapsed = time.time() - start
+    tunnels = len(server.store.data['ipsec'])
+    return {'mode': mode, 'spokes': spokes, 'tunnels': tunnels, 'requests': dict(server.store.requests),
+            'consistent': checkConsistent(server.store), 'wall': round(elapsed, 3)}
+  finally:
+    server.stop()
+    shutil.rmtree(cache_dir)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--spokes', type=int, default=100)
+  parser.add_argument('--fail', action='store_true', help='make the server reject one spoke')
+  args = parser.parse_args()
+  for mode in ('single', 'yang-patch'):
+    print(run(args.spokes, mode, args.fail))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""Check the static routes the TNSR agent keeps for spokes with several CIDR blocks.
+
+Every one of --spokes spokes has its primary /24 plus --blocks adjacent /24s
+from 100.64.0.0/10 (and one disassociated block, which must not be routed).
+The poller writes their configs to the stubbed bucket and the agent applies
+them to benchmark/fake_restconf.py, which also has a default route, a route
+via the VPP interface and a route via an ipsec tunnel set up by hand, all of
+which the agent must leave alone. The agent runs cold, once
+more with nothing to do, after --grown spoke VPCs have been given one more
+block, and after --removed spokes have been untagged. After
+each run the script reports the routes on the server next to the spoke
+subnets, the RESTCONF requests and whether every associated block of every
+spoke is routed via its own tunnel by longest prefix match and nothing else.
+
+    python benchmark/bench_agent_routes.py --spokes 500 --blocks 4 --grown 50 --removed 50
+"""
+
+import argparse
+import contextlib
+import io
+import ipaddress
+import shutil
+import sys
+import tempfile
+import time
+
+import stubs
+from fake_restconf import FakeRestconf
+
+sys.path.insert(0, stubs.ROOT)
+import transitvpc_ipsec as agent
+
+SHARED = '100.64.0.0'
+# Routes configured by hand: one via the VPP interface, one via an on-premises tunnel no config knows about
+ADMIN_TUNNEL = 99000
+MANUAL_ROUTES = [
+  {'destination-prefix': '192.0.2.0/24', 'next-hop': {'hop': [
+    {'hop-id': 1, 'ipv4-address': '10.10.0.1', 'if-name': 'VirtualFunctionEthernet0/6/0'}]}},
+  {'destination-prefix': '192.168.0.0/16', 'next-hop': {'hop': [
+    {'hop-id': 1, 'ipv4-address': '169.254.99.1', 'if-name': 'ipsec{0}'.format(ADMIN_TUNNEL)}]}},
+]
+
+
+def lookup(routes, address):
+  """The next hop interface the longest matching route sends address to."""
+  best = None
+  for prefix, route in routes.items():
+    network = ipaddress.ip_network(prefix)
+    if address in network and (best is None or network.prefixlen > best[0].prefixlen):
+      best = (network, route['next-hop']['hop'][0]['if-name'])
+  return best and best[1]
+
+
+def check(store, aws, entries):
+  """Every associated block of a spoke is routed via its tunnel, nothing of a removed spoke is, and the routes the
+  agent does not manage are as they were."""
+  routes = store.data['routes']
+  if routes.get('0.0.0.0/0', {}).get('next-hop') is None or \
+      any(routes.get(route['destination-prefix']) != route for route in MANUAL_ROUTES):
+    return False
+  tunnels = dict((tunnel['ipv4-remote-endpoint-address'], 'ipsec{0}'.format(instance))
+                 for instance, tunnel in store.data['ipip'].items())
+  # The tunnel of a spoke is found by its primary block, which the configs list first
+  gateways = dict((entry['params'].spoke_subnet, entry['params'].vpn_gateway_ip) for entry in entries.values())
+  for vgw in aws.vgws['us-east-1']:
+    vpc = aws.vpcs[vgw['VpcAttachments'][0]['VpcId']]
+    spoke = vgw['Tags'][0]['Value'] == 'true'
+    for association in vpc['CidrBlockAssociationSet']:
+      network = ipaddress.ip_network(association['CidrBlock'])
+      wanted = None
+      if spoke and association['CidrBlockState']['State'] == 'associated':
+        wanted = tunnels.get(gateways.get(vpc['CidrBlock']), 'missing')
+      for address in (network.network_address, network.broadcast_address):
+        hop = lookup(routes, address)
+        if (hop if hop and hop.startswith('ipsec') else None) != wanted:
+          return False
+  return True
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--spokes', type=int, default=500)
+  parser.add_argument('--blocks', type=int, default=4, help='extra adjacent /24 blocks per spoke VPC')
+  parser.add_argument('--grown', type=int, default=50, help='spoke VPCs given one more block before the third run')
+  parser.add_argument('--removed', type=int, default=50, help='spokes untagged before the last run')
+  args = parser.parse_args()
+
+  aws = stubs.FakeAWS(['us-east-1'])
+  shared = int(ipaddress.ip_address(SHARED))
+  for i in range(args.spokes):
+    blocks = [(str(ipaddress.ip_network((shared + (i * (args.blocks + 1) + j) * 256, 24))), 'associated')
+              for j in range(args.blocks)]
+    blocks.append((str(ipaddress.ip_network((shared + (i * (args.blocks + 1) + args.blocks) * 256, 24))),
+                   'disassociated'))
+    aws.addSpoke('us-east-1', cidr_blocks=blocks)
+  poller = stubs.attachPoller(aws, args.spokes)
+  stubs.runPoller(poller)
+
+  server = FakeRestconf().start()
+  data = server.store.data
+  data['ipip'][ADMIN_TUNNEL] = {'instance': ADMIN_TUNNEL, 'ipv4-local-endpoint-address': stubs.POLLER_ENV['PIP'],
+                                'ipv4-remote-endpoint-address': '192.0.2.99'}
+  data['ipsec'][ADMIN_TUNNEL] = {'instance': ADMIN_TUNNEL, 'tunnel-enable': True}
+  data['interfaces']['ipsec{0}'.format(ADMIN_TUNNEL)] = {'name': 'ipsec{0}'.format(ADMIN_TUNNEL), 'enabled': True}
+  for route in MANUAL_ROUTES:
+    data['routes'][route['destination-prefix']] = route
+  cache_dir = tempfile.mkdtemp()
+  stubs.attachAgent(aws, server, cache_dir)
+  ok = True
+  try:
+    for name in ('cold', 'steady', 'grown', 'removed'):
+      if name == 'grown':
+        # Blocks associated with VPCs which already have VPN connections, from the top of the shared range
+        for i, vgw in enumerate(aws.vgws['us-east-1'][:args.grown]):
+          vpc = aws.vpcs[vgw['VpcAttachments'][0]['VpcId']]
+          vpc['CidrBlockAssociationSet'].append({'CidrBlock': str(ipaddress.ip_network((shared + (16383 - i) * 256, 24))),
+                                                 'CidrBlockState': {'State': 'associated'}})
+        stubs.runPoller(poller)
+      if name == 'removed':
+        for vgw in aws.vgws['us-east-1'][:args.removed]:
+          vgw['Tags'] = [{'Key': 'transitvpc:spoke', 'Value': 'false'}]
+        stubs.runPoller(poller)
+      server.store.requests.clear()
+      start = time.time()
+      with contextlib.redirect_stdout(io.StringIO()):
+        agent.createIPSec()
+      elapsed = time.time() - start
+      entries = agent.loadSyncCache()
+      good = check(server.store, aws, entries)
+      ok = ok and good
+      print('{0:<8} spoke_subnets={1} routes={2} requests={3} wall={4:.3f}s {5}'.format(
+        name, sum(len(entry['params'].spoke_subnets) for entry in entries.values()), len(server.store.data['routes']),
+        dict(server.store.requests), elapsed, 'ok' if good else 'MISMATCH'))
+  finally:
+    server.stop()
+    shutil.rmtree(cache_dir)
+  sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+  main()
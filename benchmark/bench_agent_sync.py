@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Benchmark the TNSR agent's S3 sync against the stubbed S3 bucket.
+
+The poller writes the configs of --spokes spokes to the stubbed bucket, then
+the agent syncs them with an injected per-request S3 latency: from a cold
+cache with a single download thread and with --workers, once more with a warm
+cache, and after the poller has marked --changed spokes for deletion. This is
+done once reading the poller's manifest (a warm run is one conditional GET)
+and once with the manifest removed (a warm run lists the bucket).
+
+    python benchmark/bench_agent_sync.py --spokes 2000 --latency 0.02
+"""
+
+import argparse
+import sys
+import time
+
+import stubs
+
+sys.path.insert(0, stubs.ROOT)
+import transitvpc_ipsec as agent
+
+
+def run(mode, args):
+  aws = stubs.FakeAWS(['us-east-1'], latency=0.0, s3_latency=0.0)
+  aws.addSpokes(args.spokes)
+  poller = stubs.attachPoller(aws, args.spokes)
+
+  def pollerRun():
+    stubs.runPoller(poller)
+    if mode == 'listing':
+      aws.s3.objects.pop(poller.endpointPrefix('CSR1') + poller.MANIFEST_FILE, None)
+
+  pollerRun()
+  aws.s3_latency = args.latency
+
+  cache = {}
+  for label, workers in (('cold', 1), ('cold', args.workers), ('warm', args.workers), ('changed', args.workers)):
+    if label == 'cold':
+      cache = {}
+      stubs.resetAgent(agent)
+    if label == 'changed':
+      aws.s3_latency = 0.0
+      for vgw in aws.vgws['us-east-1'][:args.changed]:
+        vgw['Tags'] = [{'Key': 'transitvpc:spoke', 'Value': 'false'}]
+      pollerRun()
+      aws.s3_latency = args.latency
+    agent.fetch_workers = workers
+    aws.counter.calls.clear()
+    start = time.time()
+    (cache, agent.manifest_epoch, agent.manifest_generation, agent.manifest_etag,
+     agent.failed_configs) = agent.syncConfigs(aws.s3, cache)
+    elapsed = time.time() - start
+    print('{0:<8} {1:<7} workers={2:<3} configs={3} s3_requests={4} wall={5:.3f}s'.format(
+      mode, label, workers, len(cache), dict(aws.counter.calls), elapsed))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--spokes', type=int, default=1000)
+  parser.add_argument('--changed', type=int, default=10, help='spokes marked for deletion before the last sync')
+  parser.add_argument('--latency', type=float, default=0.02, help='seconds per S3 request')
+  parser.add_argument('--workers', type=int, default=16)
+  args = parser.parse_args()
+  for mode in ('listing', 'manifest'):
+    run(mode, args)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Compare the streaming VPN config codec with the minidom code it replaced.
+
+Both sides handle the same generated CustomerGatewayConfiguration documents:
+the poller's step (add the <transit_vpc_config> block) and the agent's step
+(read the tunnel parameters). For each the script reports the time per
+document and the peak memory allocated while handling one document, and
+checks that both implementations agree.
+
+    python benchmark/bench_codec.py --docs 200 --tunnels 2
+"""
+
+import argparse
+import sys
+import timeit
+import tracemalloc
+from xml.dom import minidom
+
+import stubs
+
+sys.path.insert(0, stubs.ROOT)
+import transitvpc_codec
+
+FIELDS = [('account_id', '123456789012'), ('vpn_endpoint', 'CSR1'), ('spoke_subnet', '10.1.2.0/24'),
+          ('customer_local_ip', stubs.POLLER_ENV['PIP']), ('status', 'create')]
+
+
+def minidomInject(xml, fields):
+  # The poller's updateConfigXML before the codec
+  xmldoc = minidom.parseString(xml)
+  transitConfig = xmldoc.createElement("transit_vpc_config")
+  for name, value in fields:
+    newXml = xmldoc.createElement(name)
+    newXml.appendChild(xmldoc.createTextNode(value))
+    transitConfig.appendChild(newXml)
+  xmldoc.childNodes[0].appendChild(transitConfig)
+  return str(xmldoc.toxml())
+
+
+def minidomParse(body):
+  # The agent's parseConfig before the codec
+  xmldoc = minidom.parseString(body)
+  vpn_config = xmldoc.getElementsByTagName("transit_vpc_config")[0]
+  vpn_connection = xmldoc.getElementsByTagName('vpn_connection')[0]
+  ipsec_tunnel = vpn_connection.getElementsByTagName("ipsec_tunnel")[0]
+  customer_gateway = ipsec_tunnel.getElementsByTagName("customer_gateway")[0]
+  vpn_gateway = ipsec_tunnel.getElementsByTagName("vpn_gateway")[0]
+  ike_config = ipsec_tunnel.getElementsByTagName("ike")[0]
+  return {
+    'vpn_status': vpn_config.getElementsByTagName("status")[0].firstChild.data,
+    'spoke_subnet': vpn_config.getElementsByTagName('spoke_subnet')[0].firstChild.data,
+    'customer_gateway_ip': customer_gateway.getElementsByTagName("tunnel_outside_address")[0].getElementsByTagName("ip_address")[0].firstChild.data,
+    'customer_inside_ip': customer_gateway.getElementsByTagName("tunnel_inside_address")[0].getElementsByTagName("ip_address")[0].firstChild.data,
+    'customer_local_ip': vpn_config.getElementsByTagName("customer_local_ip")[0].firstChild.data,
+    'vpn_gateway_ip': vpn_gateway.getElementsByTagName("tunnel_outside_address")[0].getElementsByTagName("ip_address")[0].firstChild.data,
+    'vpn_inside_ip': vpn_gateway.getElementsByTagName("tunnel_inside_address")[0].getElementsByTagName("ip_address")[0].firstChild.data,
+    'ike_psk': ike_config.getElementsByTagName("pre_shared_key")[0].firstChild.data,
+  }
+
+
+def measure(function, docs, repeat):
+  """Return (microseconds per document, peak KiB allocated while handling one document)."""
+  elapsed = min(timeit.repeat(lambda: [function(doc) for doc in docs], number=1, repeat=repeat))
+  tracemalloc.start()
+  peak = 0
+  for doc in docs:
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    function(doc)
+    peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+  tracemalloc.stop()
+  return elapsed / len(docs) * 1e6, peak / 1024.0
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--docs', type=int, default=200)
+  parser.add_argument('--tunnels', type=int, default=2, help='ipsec_tunnel elements per document')
+  parser.add_argument('--repeat', type=int, default=5)
+  args = parser.parse_args()
+
+  ec2_docs = [stubs.vpnConfigXML('vpn-%08x' % i, ['198.51.100.%d' % (n + 1) for n in range(args.tunnels)],
+                                 stubs.POLLER_ENV['EIP'], i) for i in range(args.docs)]
+  s3_docs = [transitvpc_codec.injectTransitConfig(doc, FIELDS).encode('utf-8') for doc in ec2_docs]
+  for ec2_doc, s3_doc in zip(ec2_docs, s3_docs):
+    assert minidomParse(minidomInject(ec2_doc, FIELDS)) == minidomParse(s3_doc)
+    fields = transitvpc_codec.parseVpnConfig(s3_doc).asDict()
+    # The minidom code read a single spoke subnet
+    assert fields.pop('spoke_subnets') == [fields['spoke_subnet']]
+    assert fields == minidomParse(s3_doc)
+
+  inject = lambda xml: transitvpc_codec.injectTransitConfig(xml, FIELDS)
+  cases = [
+    ('poller inject', lambda xml: minidomInject(xml, FIELDS), inject, ec2_docs),
+    ('agent parse', minidomParse, transitvpc_codec.parseVpnConfig, s3_docs),
+  ]
+  print('{0} documents, {1} tunnels, {2} bytes each'.format(args.docs, args.tunnels, len(s3_docs[0])))
+  for name, old, new, docs in cases:
+    old_time, old_peak = measure(old, docs, args.repeat)
+    new_time, new_peak = measure(new, docs, args.repeat)
+    print('{0:<14} minidom {1:8.1f} us {2:7.1f} KiB   codec {3:8.1f} us {4:7.1f} KiB   {5:.1f}x faster'.format(
+      name, old_time, old_peak, new_time, new_peak, old_time / new_time))
+
+
+if __name__ == '__main__':
+  main()
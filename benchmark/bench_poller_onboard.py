@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Onboard a burst of spokes against stubbed EC2 which throttles like the real service.
+
+The stubbed EC2 keeps a describe and a mutate token bucket per region and
+refuses calls with RequestLimitExceeded once they are empty. --spokes new
+spokes are onboarded by running the poller until every one has its VPN
+connection, once with the poller's rate limiter sized to the stubbed buckets
+and once with the limiter off. The stubs do not retry, so a refused call
+fails its spoke, or the whole run, until a later run; the buckets refill for
+--pause seconds between runs. For each the script reports the runs needed and
+how many of them failed, the wall time, the calls EC2 refused and the VPN
+connections created, which must be one per spoke.
+
+    python benchmark/bench_poller_onboard.py --spokes 200 --mutate-rate 50 --mutate-burst 20
+"""
+
+import argparse
+import logging
+import time
+
+import stubs
+
+
+def run(poller, spokes, throttle, limited, max_runs, pause):
+  aws = stubs.FakeAWS(['us-east-1'])
+  aws.throttle = throttle
+  aws.addSpokes(spokes)
+
+  stubs.attachPoller(aws, spokes, poller)
+  poller.EC2_DESCRIBE_RATE, poller.EC2_DESCRIBE_BURST = throttle['describe'] if limited else (0, 0)
+  poller.EC2_MUTATE_RATE, poller.EC2_MUTATE_BURST = throttle['mutate'] if limited else (0, 0)
+  poller.spoke_credentials.clear()
+  poller.ec2_clients.clear()
+  poller.ec2_limiters.clear()
+  poller.s3_client = None
+
+  start = time.time()
+  runs = failed_runs = 0
+  while True:
+    runs += 1
+    try:
+      stubs.runPoller(poller)
+    except stubs.ClientError:
+      failed_runs += 1
+    onboarded = set(vpn['VpnGatewayId'] for vpn in aws.vpns.get('us-east-1', []))
+    if len(onboarded) == spokes or runs == max_runs:
+      break
+    time.sleep(pause)
+  return {'limiter': 'on' if limited else 'off', 'spokes': spokes, 'onboarded': len(onboarded), 'runs': runs,
+          'failed_runs': failed_runs, 'wall': round(time.time() - start - (runs - 1) * pause, 3), 'throttled': aws.counter.total('throttled.'),
+          'vpn_connections': len(aws.vpns.get('us-east-1', []))}
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--spokes', type=int, default=200)
+  parser.add_argument('--describe-rate', type=float, default=100)
+  parser.add_argument('--describe-burst', type=int, default=50)
+  parser.add_argument('--mutate-rate', type=float, default=50)
+  parser.add_argument('--mutate-burst', type=int, default=20)
+  parser.add_argument('--max-runs', type=int, default=20, help='poller runs before giving up')
+  parser.add_argument('--pause', type=float, default=1.0, help='seconds between poller runs')
+  args = parser.parse_args()
+
+  throttle = {'describe': (args.describe_rate, args.describe_burst), 'mutate': (args.mutate_rate, args.mutate_burst)}
+  poller = stubs.loadPoller()
+  # Every refused call logs a traceback
+  poller.log.setLevel(logging.CRITICAL)
+  for limited in (True, False):
+    print(run(poller, args.spokes, throttle, limited, args.max_runs, args.pause))
+
+
+if __name__ == '__main__':
+  main()
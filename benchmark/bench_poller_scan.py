@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Benchmark the poller region scan against stubbed EC2 clients.
+
+Every stubbed EC2 and STS call sleeps for --latency seconds to stand in for
+the API round trip, so the sequential scan costs about accounts x regions x
+calls x latency while the concurrent scan should cost about one region's
+worth. With --accounts the poller also scans that many spoke accounts through
+their assumed roles. Each scan runs twice: roles are assumed and EC2 clients
+built on the first (cold) run only.
+
+    python benchmark/bench_poller_scan.py --regions 17 --accounts 10 --latency 0.2
+"""
+
+import argparse
+import time
+
+import stubs
+
+
+def run(poller, regions, accounts, vgws, latency, workers):
+  aws = stubs.FakeAWS(regions, latency)
+  estates = [aws] + [aws.addAccount('2100000000%02d' % n) for n in range(accounts)]
+  for estate in estates:
+    estate.addSpokes(vgws * len(regions), tag_value='false')
+
+  stubs.attachPoller(aws, poller=poller)
+  poller.SCAN_WORKERS = workers
+  poller.SPOKE_ACCOUNTS = [estate.account_id for estate in estates[1:]]
+  poller.spoke_credentials.clear()
+  poller.ec2_clients.clear()
+  poller.ec2_limiters.clear()
+  poller.s3_client = None
+  results = []
+  for label in ('cold', 'warm'):
+    aws.counter.calls.clear()
+    start = time.time()
+    stubs.runPoller(poller)
+    results.append((label, time.time() - start, aws.counter.total('ec2.'), aws.counter.total('sts.'),
+                    aws.counter.total('client.ec2')))
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--regions', type=int, default=17)
+  parser.add_argument('--accounts', type=int, default=0, help='spoke accounts besides the poller\'s own')
+  parser.add_argument('--vgws', type=int, default=20, help='VGWs per region')
+  parser.add_argument('--latency', type=float, default=0.1, help='seconds per EC2 call')
+  parser.add_argument('--workers', type=int, default=32)
+  args = parser.parse_args()
+
+  poller = stubs.loadPoller()
+  regions = ['region-%d' % i for i in range(args.regions)]
+  for workers in (1, args.workers):
+    for label, elapsed, calls, sts_calls, clients in run(poller, regions, args.accounts, args.vgws, args.latency,
+                                                         workers):
+      print('workers={0:<3} {1} accounts={2} regions={3} ec2_calls={4} sts_calls={5} ec2_clients={6} wall={7:.3f}s'.format(
+        workers, label, args.accounts + 1, args.regions, calls, sts_calls, clients, elapsed))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Check how the poller spreads spokes over several TNSR endpoints.
+
+First the endpoint choice alone: --spokes VGW ids are assigned to --endpoints
+endpoints, then to one more, and the script reports how evenly they are
+spread and how many would move, next to plain modulo hashing. Then the
+poller runs against stubbed AWS with that many endpoints and every endpoint's
+agent syncs its own prefix, which must hold exactly the spokes assigned to it
+with the endpoint's private IP as local address.
+
+    python benchmark/bench_sharding.py --spokes 1000 --endpoints 3
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+import stubs
+
+sys.path.insert(0, stubs.ROOT)
+import transitvpc_ipsec as agent
+
+
+def endpoints(count):
+  return [{'name': 'CSR%d' % (n + 1), 'eip': '203.0.113.%d' % (10 + n), 'pip': '10.10.%d.101' % n}
+          for n in range(count)]
+
+
+def modulo(names, vgw_id):
+  return names[int(hashlib.md5(vgw_id.encode()).hexdigest(), 16) % len(names)]
+
+
+def spread(assignment):
+  counts = {}
+  for name in assignment.values():
+    counts[name] = counts.get(name, 0) + 1
+  return dict(sorted(counts.items()))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--spokes', type=int, default=1000)
+  parser.add_argument('--endpoints', type=int, default=3)
+  args = parser.parse_args()
+
+  os.environ['ENDPOINTS'] = json.dumps(endpoints(args.endpoints))
+  poller = stubs.loadPoller()
+  vgw_ids = ['vgw-%08x' % (n + 1) for n in range(args.spokes)]
+
+  before = dict((vgw_id, poller.pickEndpoint(vgw_id)['name']) for vgw_id in vgw_ids)
+  poller.ENDPOINTS = endpoints(args.endpoints + 1)
+  after = dict((vgw_id, poller.pickEndpoint(vgw_id)['name']) for vgw_id in vgw_ids)
+  names = [endpoint['name'] for endpoint in endpoints(args.endpoints)]
+  grown = [endpoint['name'] for endpoint in poller.ENDPOINTS]
+  modulo_moved = sum(1 for vgw_id in vgw_ids if modulo(names, vgw_id) != modulo(grown, vgw_id))
+  print('rendezvous {0} endpoints: {1}'.format(args.endpoints, spread(before)))
+  print('rendezvous {0} endpoints: {1}'.format(args.endpoints + 1, spread(after)))
+  print('moved when adding an endpoint: rendezvous {0:.1%}, modulo {1:.1%}, ideal {2:.1%}'.format(
+    sum(1 for vgw_id in vgw_ids if before[vgw_id] != after[vgw_id]) / float(args.spokes),
+    modulo_moved / float(args.spokes), 1.0 / (args.endpoints + 1)))
+
+  # The poller writes every spoke under the prefix of its endpoint
+  poller.ENDPOINTS = endpoints(args.endpoints)
+  aws = stubs.FakeAWS(['us-east-1'])
+  aws.addSpokes(args.spokes)
+  stubs.runPoller(stubs.attachPoller(aws, args.spokes, poller))
+
+  expected = spread(dict((vgw['VpnGatewayId'], poller.pickEndpoint(vgw['VpnGatewayId'])['name'])
+                         for vgw in aws.vgws['us-east-1']))
+  ok = True
+  for endpoint in poller.ENDPOINTS:
+    agent.config_prefix = poller.endpointPrefix(endpoint['name'])
+    agent.manifest_key = agent.config_prefix + 'manifest.json'
+    stubs.resetAgent(agent)
+    entries = agent.syncConfigs(aws.s3, {})[0]
+    local_ips = set(entry['params'].customer_local_ip for entry in entries.values())
+    good = len(entries) == expected.get(endpoint['name'], 0) and local_ips <= set([endpoint['pip']])
+    ok = ok and good
+    print('{0}: {1} configs under {2}, local address {3}, {4}'.format(
+      endpoint['name'], len(entries), agent.config_prefix, sorted(local_ips), 'ok' if good else 'MISMATCH'))
+  sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""Run the poller and the TNSR agent offline at several scales and record the results as JSON.
+
+Each scenario runs in its own Python process so that its peak RSS is its own:
+
+  poller  the Lambda handler onboards --spokes spokes spread over --regions
+          regions of stubbed EC2 (running until every spoke has its VPN
+          connection), then runs once more with nothing to do.
+  agent   the poller writes the configs of --spokes spokes to the stubbed
+          bucket, then the agent applies them to benchmark/fake_restconf.py
+          (cold) and runs once more as a freshly started script would with
+          nothing to do (steady). The fake server is reached over HTTPS with
+          client certificates, made with openssl for the run, unless --no-tls
+          is given.
+
+Stubbed EC2 and S3 calls sleep for --ec2-latency and --s3-latency seconds.
+For every phase the results hold the wall time, the AWS calls by operation,
+the RESTCONF requests by method, the metrics the component recorded itself
+(time per phase, API calls, gauges) and the peak RSS of the process so far;
+the RSS includes the stand-ins, which run in the same process, so
+setup_rss_kib records it before the first phase. Results go to --output (stdout by default)
+together with the git revision and Python version they were taken with.
+
+    python benchmark/bench_suite.py --sizes 10,100,1000,5000 --output results.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import stubs
+
+sys.path.insert(0, stubs.ROOT)
+import transitvpc_metrics
+
+SCENARIOS = ('poller', 'agent')
+
+
+def peakRss():
+  # ru_maxrss is in KiB on Linux but in bytes on macOS
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def makeCerts(directory):
+  """Create a CA, a server certificate for 127.0.0.1 and a client certificate signed by it with openssl."""
+  def openssl(*args):
+    subprocess.run(('openssl',) + args, cwd=directory, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+  openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=transitvpc-bench-ca',
+          '-addext', 'basicConstraints=critical,CA:TRUE', '-addext', 'keyUsage=critical,keyCertSign,cRLSign',
+          '-keyout', 'ca.key', '-out', 'ca.crt')
+  for name, extensions in (('server', 'subjectAltName=IP:127.0.0.1\nextendedKeyUsage=serverAuth\n'),
+                           ('client', 'extendedKeyUsage=clientAuth\n')):
+    with open(os.path.join(directory, name + '.ext'), 'w') as f:
+      f.write('basicConstraints=CA:FALSE\nkeyUsage=critical,digitalSignature,keyEncipherment\n' + extensions)
+    openssl('req', '-newkey', 'rsa:2048', '-nodes', '-subj', '/CN=transitvpc-bench-' + name,
+            '-keyout', name + '.key', '-out', name + '.csr')
+    openssl('x509', '-req', '-days', '1', '-in', name + '.csr', '-CA', 'ca.crt', '-CAkey', 'ca.key',
+            '-CAcreateserial', '-extfile', name + '.ext', '-out', name + '.crt')
+  return dict((name, os.path.join(directory, name)) for name in
+              ('ca.crt', 'server.crt', 'server.key', 'client.crt', 'client.key'))
+
+
+def fakeAWS(args):
+  aws = stubs.FakeAWS(['region-%d' % n for n in range(args.regions)], args.ec2_latency, args.s3_latency)
+  aws.addSpokes(args.spokes)
+  return aws
+
+
+def runPoller(poller, aws, spokes, max_runs, metrics=None):
+  """Run the handler until every spoke has its VPN connection and return the number of runs. The metrics of the
+  runs are added up in metrics."""
+  runs = 0
+  while runs < max_runs:
+    runs += 1
+    stubs.runPoller(poller)
+    if metrics is not None:
+      merge(metrics, poller.metrics)
+    if sum(len(set(vpn['VpnGatewayId'] for vpn in vpns)) for vpns in aws.vpns.values()) >= spokes:
+      break
+  return runs
+
+
+def merge(total, metrics):
+  """Add the timers and counters of metrics to total and take over its gauges."""
+  timers, counters, gauges = metrics.snapshot()
+  for key, (count, seconds, longest) in timers.items():
+    old = total.timers.get(key, (0, 0.0, 0.0))
+    total.timers[key] = (old[0] + count, old[1] + seconds, max(old[2], longest))
+  for key, value in counters.items():
+    total.counters[key] = total.counters.get(key, 0) + value
+  total.gauges.update(gauges)
+
+
+def flatten(metrics):
+  # Named as in the poller's EMF output
+  return dict((name, value) for document in metrics.emf('bench', {}) for name, value in document.items()
+              if name != '_aws')
+
+
+def phase(name, aws, started, metrics, **fields):
+  fields.update({'phase': name, 'wall': round(time.time() - started, 3), 'aws_calls': dict(aws.counter.calls),
+                 'metrics': flatten(metrics), 'peak_rss_kib': peakRss()})
+  aws.counter.calls.clear()
+  return fields
+
+
+def scenarioPoller(args):
+  aws = fakeAWS(args)
+  poller = stubs.attachPoller(aws, args.spokes)
+  setup_rss = peakRss()
+
+  phases = []
+  metrics = transitvpc_metrics.Metrics()
+  started = time.time()
+  runs = runPoller(poller, aws, args.spokes, args.max_runs, metrics)
+  phases.append(phase('onboard', aws, started, metrics, runs=runs))
+  started = time.time()
+  stubs.runPoller(poller)
+  phases.append(phase('steady', aws, started, poller.metrics, runs=1))
+  return setup_rss, phases, {'vpn_connections': sum(len(vpns) for vpns in aws.vpns.values())}
+
+
+def scenarioAgent(args):
+  from fake_restconf import FakeRestconf
+  from bench_agent_apply import checkConsistent
+
+  aws = fakeAWS(args)
+  # The S3 stand-in only answers with latency once the poller has written the configs
+  s3_latency, aws.s3_latency = aws.s3_latency, 0.0
+  runPoller(stubs.attachPoller(aws, args.spokes), aws, args.spokes, args.max_runs)
+  aws.s3_latency = s3_latency
+  aws.counter.calls.clear()
+
+  cache_dir = tempfile.mkdtemp()
+  if args.certs:
+    server = FakeRestconf(cert=args.certs['server.crt'], key=args.certs['server.key'], ca=args.certs['ca.crt'])
+    agent = stubs.attachAgent(aws, server, cache_dir, cert=(args.certs['client.crt'], args.certs['client.key']),
+                              verify=args.certs['ca.crt'])
+  else:
+    server = FakeRestconf()
+    agent = stubs.attachAgent(aws, server, cache_dir)
+  server.start()
+  setup_rss = peakRss()
+
+  phases = []
+  try:
+    for name in ('cold', 'steady'):
+      # Every run starts like a freshly started script, from the cache file only
+      stubs.resetAgent(agent)
+      agent.metrics.reset()
+      server.store.requests.clear()
+      started = time.time()
+      with contextlib.redirect_stdout(io.StringIO()):
+        agent.createIPSec()
+      phases.append(phase(name, aws, started, agent.metrics, rest_requests=dict(server.store.requests)))
+    tunnels = len(server.store.data['ipsec'])
+    return setup_rss, phases, {'tunnels': tunnels, 'consistent': checkConsistent(server.store), 'tls': bool(args.certs)}
+  finally:
+    server.stop()
+    shutil.rmtree(cache_dir)
+
+
+def runScenario(args):
+  setup_rss, phases, checks = {'poller': scenarioPoller, 'agent': scenarioAgent}[args.run](args)
+  result = {'scenario': args.run, 'spokes': args.spokes, 'regions': args.regions, 'ec2_latency': args.ec2_latency,
+            's3_latency': args.s3_latency, 'setup_rss_kib': setup_rss, 'phases': phases}
+  result.update(checks)
+  print(json.dumps(result))
+
+
+def gitRevision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=stubs.ROOT, stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--sizes', default='10,100,1000,5000', help='comma separated numbers of spokes')
+  parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+  parser.add_argument('--regions', type=int, default=4)
+  parser.add_argument('--ec2-latency', type=float, default=0.0, help='seconds per stubbed EC2 and STS call')
+  parser.add_argument('--s3-latency', type=float, default=0.0, help='seconds per stubbed S3 call')
+  parser.add_argument('--max-runs', type=int, default=20, help='poller runs before giving up on onboarding')
+  parser.add_argument('--no-tls', action='store_true', help='serve RESTCONF over plain HTTP')
+  parser.add_argument('--output', help='file to write the results to')
+  # Used by the child processes
+  parser.add_argument('--run', choices=SCENARIOS, help=argparse.SUPPRESS)
+  parser.add_argument('--spokes', type=int, help=argparse.SUPPRESS)
+  parser.add_argument('--cert-dir', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.run:
+    args.certs = None
+    if args.cert_dir:
+      args.certs = dict((name, os.path.join(args.cert_dir, name)) for name in
+                        ('ca.crt', 'server.crt', 'server.key', 'client.crt', 'client.key'))
+    runScenario(args)
+    return
+
+  report = {'started': datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z', 'git': gitRevision(),
+            'python': platform.python_version(), 'platform': platform.platform(), 'results': []}
+  results = report['results']
+  cert_dir = None if args.no_tls else tempfile.mkdtemp()
+  try:
+    if cert_dir:
+      makeCerts(cert_dir)
+    for spokes in [int(size) for size in args.sizes.split(',')]:
+      for scenario in args.scenarios.split(','):
+        command = [sys.executable, os.path.abspath(__file__), '--run', scenario, '--spokes', str(spokes),
+                   '--regions', str(args.regions), '--ec2-latency', str(args.ec2_latency),
+                   '--s3-latency', str(args.s3_latency), '--max-runs', str(args.max_runs)]
+        if cert_dir:
+          command += ['--cert-dir', cert_dir]
+        started = time.time()
+        child = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if child.returncode != 0:
+          result = {'scenario': scenario, 'spokes': spokes, 'error': 'exit status %d' % child.returncode}
+        else:
+          result = json.loads(child.stdout.decode().strip().splitlines()[-1])
+        result['process_wall'] = round(time.time() - started, 3)
+        results.append(result)
+        print('{0:<6} spokes={1:<5} {2}'.format(scenario, spokes, result.get('error') or ' '.join(
+          '{0}={1}s'.format(p['phase'], p['wall']) for p in result['phases'])), file=sys.stderr)
+  finally:
+    if cert_dir:
+      shutil.rmtree(cert_dir)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+  else:
+    print(json.dumps(report, indent=2))
+  sys.exit(1 if any('error' in result for result in results) else 0)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""A local stand-in for the TNSR RESTCONF API used by transitvpc_ipsec.py.
+
+It keeps ipip tunnels, IPsec tunnels, interfaces and IPv4 static routes in
+memory and serves the GET/PUT/DELETE paths the agent uses plus YANG-PATCH
+(RFC 8072) on the datastore, which is applied atomically. It checks the
+references TNSR would check (an IPsec tunnel needs its ipip tunnel, an ipsecN
+interface needs its IPsec tunnel, a route needs its interface), can be told
+to reject changes to chosen paths, and counts requests by method.
+
+Run standalone (optionally with TLS and client certificates):
+
+    python benchmark/fake_restconf.py --port 8443 --cert server.crt --key server.key --ca ca.crt
+"""
+
+import argparse
+import json
+import re
+import ssl
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = '/restconf/data'
+
+LISTS = [
+  # (name, list path, container, list key, item key in bodies, key field)
+  ('ipip', '/netgate-tunnel:tunnels-config/netgate-ipip:ipip', 'netgate-ipip:ipip', 'tunnel',
+   'netgate-ipip:tunnel', 'instance'),
+  ('ipsec', '/netgate-ipsec:ipsec-config', 'netgate-ipsec:ipsec-config', 'tunnel',
+   'netgate-ipsec:tunnel', 'instance'),
+  ('interfaces', '/netgate-interface:interfaces-config', 'netgate-interface:interfaces-config', 'interface',
+   'netgate-interface:interface', 'name'),
+  ('routes', '/netgate-route-table:route-table-config/static-routes/route-table=ipv4-VRF:0/ipv4-routes',
+   'netgate-route-table:ipv4-routes', 'route', 'netgate-route-table:route', 'destination-prefix'),
+]
+
+
+class RestconfError(Exception):
+  def __init__(self, status, message):
+    Exception.__init__(self, message)
+    self.status = status
+
+
+class Datastore(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.data = dict((name, {}) for name, _, _, _, _, _ in LISTS)
+    # What an AWS TNSR instance has before the agent runs: the VPP interface and its default route
+    self.data['interfaces']['VirtualFunctionEthernet0/6/0'] = {'name': 'VirtualFunctionEthernet0/6/0', 'enabled': True}
+    self.data['routes']['0.0.0.0/0'] = {'destination-prefix': '0.0.0.0/0', 'next-hop': {'hop': [
+      {'hop-id': 1, 'ipv4-address': '10.10.0.1', 'if-name': 'VirtualFunctionEthernet0/6/0'}]}}
+    self.fail = set()
+    self.requests = {}
+
+  def resolve(self, path):
+    """Return (list spec, item key or None) for a data path."""
+    for spec in LISTS:
+      name, list_path, _, _, _, key_field = spec
+      if path == list_path:
+        return spec, None
+      if path.startswith(list_path + '/'):
+        match = re.match(r'^/[a-z-]+=(.+)$', path[len(list_path):])
+        if match:
+          key = urllib.parse.unquote_plus(match.group(1))
+          return spec, int(key) if key_field == 'instance' else key
+    raise RestconfError(404, 'unknown path ' + path)
+
+  def get(self, path):
+    spec, key = self.resolve(path)
+    name, _, container, list_key, item_key, _ = spec
+    items = self.data[name]
+    if key is None:
+      if not items:
+        raise RestconfError(404, 'no ' + name)
+      return {container: {list_key: list(items.values())}}
+    if key not in items:
+      raise RestconfError(404, '%s %s not found' % (name, key))
+    return {item_key: [items[key]]}
+
+  def put(self, data, path, body):
+    spec, key = self.resolve(path)
+    name, _, _, _, item_key, key_field = spec
+    if key is None or item_key not in body:
+      raise RestconfError(400, 'bad PUT to ' + path)
+    item = body[item_key]
+    if isinstance(item, list):
+      item = item[0]
+    if item.get(key_field) != key:
+      raise RestconfError(400, 'key of %s does not match the path' % name)
+    if path in self.fail:
+      raise RestconfError(400, 'rejected change to ' + path)
+    # The references TNSR validates before committing
+    if name == 'ipsec' and key not in data['ipip']:
+      raise RestconfError(400, 'ipsec tunnel %s has no ipip tunnel' % key)
+    if name == 'interfaces' and key.startswith('ipsec') and int(key[5:]) not in data['ipsec']:
+      raise RestconfError(400, 'interface %s has no ipsec tunnel' % key)
+    if name == 'routes':
+      for hop in item.get('next-hop', {}).get('hop', []):
+        if hop.get('if-name') not in data['interfaces']:
+          raise RestconfError(400, 'route %s uses unknown interface %s' % (key, hop.get('if-name')))
+    data[name][key] = item
+
+  def delete(self, data, path, missing_ok=False):
+    spec, key = self.resolve(path)
+    name = spec[0]
+    if path in self.fail:
+      raise RestconfError(400, 'rejected change to ' + path)
+    if key not in data[name]:
+      if missing_ok:
+        return
+      raise RestconfError(404, '%s %s not found' % (name, key))
+    del data[name][key]
+
+  def yangPatch(self, body):
+    # Edits are applied to a copy which only replaces the datastore if all of them succeed. Items are replaced
+    # rather than changed in place, so copying the lists is enough.
+    data = dict((name, dict(items)) for name, items in self.data.items())
+    patch = body['ietf-yang-patch:yang-patch']
+    for edit in patch['edit']:
+      operation = edit['operation']
+      if operation in ('create', 'merge', 'replace'):
+        self.put(data, edit['target'], edit['value'])
+      elif operation in ('delete', 'remove'):
+        self.delete(data, edit['target'], missing_ok=operation == 'remove')
+      else:
+        raise RestconfError(400, 'unsupported operation ' + operation)
+    self.data = data
+    return {'ietf-yang-patch:yang-patch-status': {'patch-id': patch['patch-id'], 'ok': [None]}}
+
+  def count(self, method):
+    self.requests[method] = self.requests.get(method, 0) + 1
+
+
+class Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Headers and body are written separately, which Nagle's algorithm would hold back for a delayed ACK
+  disable_nagle_algorithm = True
+
+  def log_message(self, *args):
+    pass
+
+  def handle_one(self, method):
+    store = self.server.store
+    length = int(self.headers.get('Content-Length') or 0)
+    raw = self.rfile.read(length) if length else b''
+    path = urllib.parse.urlsplit(self.path).path
+    status, reply = 200, None
+    with store.lock:
+      store.count(method)
+      try:
+        if not path.startswith(PREFIX):
+          raise RestconfError(404, 'not a RESTCONF data path')
+        path = path[len(PREFIX):]
+        if method == 'GET':
+          reply = store.get(path)
+        elif method == 'PUT':
+          store.put(store.data, path, json.loads(raw))
+          status = 201
+        elif method == 'DELETE':
+          store.delete(store.data, path)
+          status = 204
+        elif method == 'PATCH':
+          if self.server.yang_patch and self.headers.get('Content-Type') == 'application/yang-patch+json' and path == '':
+            reply = store.yangPatch(json.loads(raw))
+          else:
+            raise RestconfError(415, 'unsupported media type')
+      except RestconfError as e:
+        status = e.status
+        reply = {'ietf-restconf:errors': {'error': [{'error-type': 'application', 'error-message': str(e)}]}}
+    body = json.dumps(reply).encode() if reply is not None else b''
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/yang-data+json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    self.handle_one('GET')
+
+  def do_PUT(self):
+    self.handle_one('PUT')
+
+  def do_DELETE(self):
+    self.handle_one('DELETE')
+
+  def do_PATCH(self):
+    self.handle_one('PATCH')
+
+
+class FakeRestconf(object):
+  """Serve a Datastore on 127.0.0.1 from a background thread. With cert/key/ca the client must present a
+  certificate signed by ca, like TNSR configured with 'global authentication-type client-certificate'."""
+
+  def __init__(self, port=0, cert=None, key=None, ca=None, yang_patch=True):
+    self.store = Datastore()
+    self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    self.httpd.daemon_threads = True
+    self.httpd.store = self.store
+    self.httpd.yang_patch = yang_patch
+    scheme = 'http'
+    if cert:
+      context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+      context.load_cert_chain(cert, key)
+      if ca:
+        context.load_verify_locations(ca)
+        context.verify_mode = ssl.CERT_REQUIRED
+      self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+      scheme = 'https'
+    self.url = '{0}://127.0.0.1:{1}{2}'.format(scheme, self.httpd.server_address[1], PREFIX)
+    self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+  def start(self):
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.httpd.shutdown()
+    self.httpd.server_close()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--port', type=int, default=8443)
+  parser.add_argument('--cert')
+  parser.add_argument('--key')
+  parser.add_argument('--ca')
+  parser.add_argument('--no-yang-patch', action='store_true', help='answer YANG-PATCH with 415')
+  args = parser.parse_args()
+  server = FakeRestconf(args.port, args.cert, args.key, args.ca, not args.no_yang_patch)
+  print('Serving', server.url)
+  server.httpd.serve_forever()
+
+
+if __name__ == '__main__':
+  main()
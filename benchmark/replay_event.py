@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""Feed a recorded EventBridge event to the poller against stubbed AWS clients.
+
+The stub estate has a newly tagged spoke (vgw-00000001 in us-east-1), a spoke
+being removed (vgw-00000002 in eu-west-1) and --filler untouched spokes per
+region, so the output shows which VGWs the event reconciled and what it cost.
+
+    python benchmark/replay_event.py lambda/events/tag-change.json
+"""
+
+import argparse
+import json
+
+import stubs
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('event', help='recorded event JSON file')
+  parser.add_argument('--filler', type=int, default=50, help='untouched spokes per region')
+  args = parser.parse_args()
+
+  aws = stubs.FakeAWS(['us-east-1', 'eu-west-1', 'ap-southeast-2'])
+  aws.addSpoke('us-east-1')
+  aws.addSpoke('eu-west-1', tag_value='false', vpn_endpoint='CSR1')
+  for region in aws.regions:
+    for i in range(args.filler):
+      aws.addSpoke(region, vpn_endpoint='CSR1')
+
+  with open(args.event) as f:
+    stubs.runPoller(stubs.attachPoller(aws), json.load(f))
+
+  print(json.dumps({'api_calls': aws.counter.calls, 's3_objects': sorted(aws.s3.objects)}, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+  main()
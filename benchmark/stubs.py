@@ -0,0 +1,471 @@
+"""Offline stand-ins for the AWS services used by the poller and the TNSR agent.
+
+FakeAWS keeps the state of a small AWS estate (VGWs, VPCs, VPN connections
+and the config bucket, optionally spread over several accounts) and hands out
+EC2, S3 and STS clients which implement just the calls the scripts make.
+Every call sleeps for the configured latency and is counted so benchmarks can
+report API call totals. EC2 can also throttle calls with token buckets like
+the real service.
+"""
+
+import datetime
+import hashlib
+import importlib.util
+import io
+import itertools
+import os
+import sys
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+POLLER = os.path.join(ROOT, 'lambda', 'transit-vpc-poller.py')
+
+POLLER_ENV = {
+  'BUCKET_NAME': 'netgate-transit-vpnconfigs',
+  'BUCKET_PREFIX': 'vpnconfigs/',
+  'EIP': '203.0.113.10',
+  'PIP': '10.10.0.101',
+  'HUB_TAG': 'transitvpc:spoke',
+  'HUB_TAG_VALUE': 'true',
+  'BGP_ASN': '64525',
+  # The stubbed EC2 only throttles when asked to, so the poller need not pace its calls
+  'EC2_DESCRIBE_RATE': '0',
+  'EC2_MUTATE_RATE': '0',
+  # Metrics are only printed by the benchmarks that ask for them
+  'METRICS_NAMESPACE': '',
+}
+
+
+def loadPoller():
+  """Import lambda/transit-vpc-poller.py (its file name is not a valid module name)."""
+  for key, value in POLLER_ENV.items():
+    os.environ.setdefault(key, value)
+  # The Lambda package ships transitvpc_codec.py next to the poller
+  if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+  spec = importlib.util.spec_from_file_location('transit_vpc_poller', POLLER)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+def attachPoller(aws, max_work_items=None, poller=None):
+  """Load the poller (or take the one already loaded) with its boto3 clients handed out by aws. max_work_items caps
+  the VGWs one run processes."""
+  poller = poller or loadPoller()
+  poller.boto3.client = aws.client
+  if max_work_items is not None:
+    poller.MAX_WORK_ITEMS = max_work_items
+  return poller
+
+
+def runPoller(poller, event=None):
+  """Invoke the poller once, like Lambda does for event (a scheduled full sweep by default)."""
+  poller.lambda_handler(event or {}, Context())
+
+
+def attachAgent(aws, server, cache_dir, cert=None, verify=False):
+  """Point the TNSR agent at the bucket of aws and at server (a FakeRestconf), with its cache and metrics files in
+  cache_dir, and reset it to a script that has never run. Returns the agent module."""
+  if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+  import transitvpc_ipsec as agent
+  # The poller and the agent share the boto3 module
+  agent.boto3.client = lambda *args, **kwargs: aws.s3
+  agent.s3_client = None
+  agent.restconf = agent.RestconfClient(url=server.url, cert=cert, verify=verify)
+  agent.sync_cache_file = os.path.join(cache_dir, 's3-cache.json')
+  agent.metrics_file = os.path.join(cache_dir, 'transitvpc.prom')
+  resetAgent(agent)
+  return agent
+
+
+def resetAgent(agent):
+  """Forget what the agent keeps between the runs of a daemon, so the next run starts from the cache file only."""
+  agent.manifest_epoch = None
+  agent.manifest_generation = 0
+  agent.manifest_etag = None
+  agent.failed_configs = {}
+
+
+def vpnConfigXML(vpn_id, vgw_ips, cgw_ip, index=0):
+  """Return a CustomerGatewayConfiguration document shaped like the ones EC2 generates (one tunnel per VGW IP)."""
+  tunnel = """  <ipsec_tunnel>
+    <customer_gateway>
+      <tunnel_outside_address>
+        <ip_address>{cgw_ip}</ip_address>
+      </tunnel_outside_address>
+      <tunnel_inside_address>
+        <ip_address>{cgw_inside}</ip_address>
+        <network_mask>255.255.255.252</network_mask>
+        <network_cidr>30</network_cidr>
+      </tunnel_inside_address>
+    </customer_gateway>
+    <vpn_gateway>
+      <tunnel_outside_address>
+        <ip_address>{vgw_ip}</ip_address>
+      </tunnel_outside_address>
+      <tunnel_inside_address>
+        <ip_address>{vgw_inside}</ip_address>
+        <network_mask>255.255.255.252</network_mask>
+        <network_cidr>30</network_cidr>
+      </tunnel_inside_address>
+    </vpn_gateway>
+    <ike>
+      <authentication_protocol>sha1</authentication_protocol>
+      <encryption_protocol>aes-128-cbc</encryption_protocol>
+      <lifetime>28800</lifetime>
+      <perfect_forward_secrecy>group2</perfect_forward_secrecy>
+      <mode>main</mode>
+      <pre_shared_key>{psk}</pre_shared_key>
+    </ike>
+    <ipsec>
+      <protocol>esp</protocol>
+      <authentication_protocol>hmac-sha1-96</authentication_protocol>
+      <encryption_protocol>aes-128-cbc</encryption_protocol>
+      <lifetime>3600</lifetime>
+      <perfect_forward_secrecy>group2</perfect_forward_secrecy>
+      <mode>tunnel</mode>
+      <clear_df_bit>true</clear_df_bit>
+      <fragmentation_before_encryption>true</fragmentation_before_encryption>
+      <tcp_mss_adjustment>1379</tcp_mss_adjustment>
+      <dead_peer_detection>
+        <delay>10</delay>
+        <retry>3</retry>
+      </dead_peer_detection>
+    </ipsec>
+  </ipsec_tunnel>
+"""
+  tunnels = ''
+  for n, vgw_ip in enumerate(vgw_ips):
+    inside = 4 * ((2 * index + n) % 16384)
+    prefix = '169.254.{0}.'.format(inside // 256 % 256)
+    tunnels += tunnel.format(cgw_ip=cgw_ip, cgw_inside=prefix + str(inside % 256 + 2), vgw_ip=vgw_ip,
+                             vgw_inside=prefix + str(inside % 256 + 1),
+                             psk='psk_{0}_{1}'.format(vpn_id.replace('-', '_'), n + 1))
+  return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+          '<vpn_connection id="{vpn_id}">\n'
+          '  <customer_gateway_id>cgw-0123456789abcdef0</customer_gateway_id>\n'
+          '  <vpn_gateway_id>vgw-0123456789abcdef0</vpn_gateway_id>\n'
+          '  <vpn_connection_type>ipsec.1</vpn_connection_type>\n'
+          '  <vpn_connection_attributes>NoBGPVPNConnection</vpn_connection_attributes>\n'
+          '{tunnels}</vpn_connection>').format(vpn_id=vpn_id, tunnels=tunnels)
+
+
+class Counter(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.calls = {}
+
+  def add(self, name):
+    with self.lock:
+      self.calls[name] = self.calls.get(name, 0) + 1
+
+  def total(self, prefix=''):
+    return sum(count for name, count in self.calls.items() if name.startswith(prefix))
+
+
+def filterValues(filters, name):
+  for f in filters or []:
+    if f['Name'] == name:
+      return f['Values']
+  return None
+
+
+class FakeAWS(object):
+  """A tiny AWS estate: spoke VGWs spread over regions plus the VPN config bucket. Spoke accounts added with
+  addAccount share the bucket and the call counter; their EC2 clients are handed out for the credentials
+  returned by the STS client."""
+
+  def __init__(self, regions, latency=0.0, s3_latency=None, account_id='123456789012'):
+    self.account_id = account_id
+    self.accounts = {account_id: self}
+    self.regions = list(regions)
+    self.latency = latency
+    self.s3_latency = latency if s3_latency is None else s3_latency
+    self.counter = Counter()
+    self.lock = threading.Lock()
+    self.vgws = dict((region, []) for region in self.regions)
+    self.vpns = dict((region, []) for region in self.regions)
+    self.vpcs = {}
+    self.ids = itertools.count(1)
+    self.s3 = FakeS3(self)
+    # {'describe': (rate, burst), 'mutate': (rate, burst)} to throttle EC2 calls per region like EC2 does
+    self.throttle = None
+    self.buckets = {}
+
+  def addSpoke(self, region, tag_value='true', vpn_endpoint=None, cidr_blocks=()):
+    """Add a VGW attached to a new VPC and tagged with tag_value; with vpn_endpoint it already has a VPN connection.
+    cidr_blocks are (CIDR, association state) pairs of the VPC besides its primary block."""
+    n = next(self.ids)
+    vpc_id = 'vpc-%08x' % n
+    vgw_id = 'vgw-%08x' % n
+    primary = '10.%d.%d.0/24' % (n // 256 % 256, n % 256)
+    self.vpcs[vpc_id] = {'VpcId': vpc_id, 'CidrBlock': primary, 'CidrBlockAssociationSet': [
+      {'CidrBlock': cidr, 'CidrBlockState': {'State': state}} for cidr, state in [(primary, 'associated')] + list(cidr_blocks)]}
+    self.vgws[region].append({'VpnGatewayId': vgw_id, 'State': 'available',
+                              'VpcAttachments': [{'VpcId': vpc_id, 'State': 'attached'}],
+                              'Tags': [{'Key': 'transitvpc:spoke', 'Value': tag_value}]})
+    if vpn_endpoint:
+      self.newVpn(region, vgw_id, 'cgw-00000001', [{'Key': 'transitvpc:spoke', 'Value': 'true'},
+                                                   {'Key': 'transitvpc:endpoint', 'Value': vpn_endpoint}])
+    return vgw_id
+
+  def addSpokes(self, count, **kwargs):
+    """Add count spokes like addSpoke, spread over the regions round robin."""
+    for n in range(count):
+      self.addSpoke(self.regions[n % len(self.regions)], **kwargs)
+
+  def addAccount(self, account_id):
+    """Add a spoke account with the same regions and return its estate."""
+    account = FakeAWS(self.regions, self.latency, self.s3_latency, account_id)
+    account.counter = self.counter
+    account.ids = self.ids
+    account.s3 = self.s3
+    account.throttle = self.throttle
+    self.accounts[account_id] = account
+    return account
+
+  def newVpn(self, region, vgw_id, cgw_id, tags=None):
+    n = next(self.ids)
+    vpn_id = 'vpn-%08x' % n
+    vpn = {'VpnConnectionId': vpn_id, 'VpnGatewayId': vgw_id, 'CustomerGatewayId': cgw_id, 'State': 'available',
+           'CustomerGatewayConfiguration': vpnConfigXML(vpn_id, ['198.51.%d.%d' % (n // 256 % 256, n % 256),
+                                                            '198.18.%d.%d' % (n // 256 % 256, n % 256)],
+                                                   POLLER_ENV['EIP'], n),
+           'Tags': list(tags or [])}
+    with self.lock:
+      self.vpns[region].append(vpn)
+    return vpn
+
+  def client(self, service, region_name=None, aws_access_key_id=None, **kwargs):
+    if service == 's3':
+      return self.s3
+    if service == 'sts':
+      return FakeSTS(self)
+    self.counter.add('client.' + service)
+    # Assumed role credentials carry the account ID in the access key
+    account = self.accounts[aws_access_key_id[4:]] if aws_access_key_id else self
+    return FakeEC2(account, region_name or 'us-east-1')
+
+
+class FakeSTS(object):
+  def __init__(self, aws):
+    self.aws = aws
+    self.meta = FakeMeta()
+
+  def assume_role(self, RoleArn, RoleSessionName, **kwargs):
+    self.aws.counter.add('sts.AssumeRole')
+    time.sleep(self.aws.latency)
+    self.meta.events.emit('after-call.sts.AssumeRole', model=FakeOperation('AssumeRole'), parsed=PARSED)
+    account_id = RoleArn.split(':')[4]
+    if account_id not in self.aws.accounts:
+      raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': RoleArn}}, 'AssumeRole')
+    return {'Credentials': {
+      'AccessKeyId': 'ASIA' + account_id, 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+      'Expiration': datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)}}
+
+
+class Bucket(object):
+  """A token bucket which refuses a call when it is empty instead of waiting."""
+
+  def __init__(self, rate, burst):
+    self.rate = rate
+    self.burst = float(burst)
+    self.tokens = float(burst)
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def take(self):
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      if self.tokens < 1:
+        return False
+      self.tokens -= 1
+      return True
+
+
+class FakeOperation(object):
+  def __init__(self, name):
+    self.name = name
+
+
+# What botocore passes to after-call handlers as the parsed response of a call that was not retried
+PARSED = {'ResponseMetadata': {'RetryAttempts': 0}}
+
+
+class FakeEvents(object):
+  """The part of botocore's event system the poller hooks into: handlers registered for before-call, after-call
+  and needs-retry events."""
+
+  def __init__(self):
+    self.handlers = []
+
+  def register(self, event_name, handler):
+    self.handlers.append((event_name, handler))
+
+  def emit(self, event_name, **kwargs):
+    for name, handler in self.handlers:
+      if event_name == name or event_name.startswith(name + '.'):
+        handler(event_name=event_name, **kwargs)
+
+
+class FakeMeta(object):
+  def __init__(self):
+    self.events = FakeEvents()
+
+
+class FakeEC2(object):
+  def __init__(self, aws, region):
+    self.aws = aws
+    self.region = region
+    self.meta = FakeMeta()
+
+  def _call(self, name):
+    self.meta.events.emit('before-call.ec2.' + name, model=FakeOperation(name), params={}, context={})
+    self.aws.counter.add('ec2.' + name)
+    if self.aws.throttle:
+      category = 'describe' if name.startswith('Describe') else 'mutate'
+      with self.aws.lock:
+        bucket = self.aws.buckets.get((self.region, category))
+        if bucket is None:
+          bucket = self.aws.buckets[(self.region, category)] = Bucket(*self.aws.throttle[category])
+      if not bucket.take():
+        self.aws.counter.add('throttled.' + name)
+        error = {'Error': {'Code': 'RequestLimitExceeded', 'Message': 'Request limit exceeded.'}}
+        # The stubs do not retry, the call fails after its first attempt
+        self.meta.events.emit('needs-retry.ec2.' + name, response=(None, error), operation=FakeOperation(name),
+                              attempts=1, caught_exception=None)
+        raise ClientError(error, name)
+    time.sleep(self.aws.latency)
+    self.meta.events.emit('after-call.ec2.' + name, model=FakeOperation(name), parsed=PARSED)
+
+  def describe_regions(self, **kwargs):
+    self._call('DescribeRegions')
+    return {'Regions': [{'RegionName': region} for region in self.aws.regions]}
+
+  def describe_vpn_gateways(self, Filters=None, **kwargs):
+    self._call('DescribeVpnGateways')
+    ids = filterValues(Filters, 'vpn-gateway-id')
+    return {'VpnGateways': [vgw for vgw in self.aws.vgws.get(self.region, [])
+                            if ids is None or vgw['VpnGatewayId'] in ids]}
+
+  def describe_vpn_connections(self, Filters=None, VpnConnectionIds=None, **kwargs):
+    self._call('DescribeVpnConnections')
+    vpns = self.aws.vpns.get(self.region, [])
+    if VpnConnectionIds is not None:
+      return {'VpnConnections': [vpn for vpn in vpns if vpn['VpnConnectionId'] in VpnConnectionIds]}
+    ids = filterValues(Filters, 'vpn-gateway-id')
+    return {'VpnConnections': [vpn for vpn in vpns if (ids is None or vpn['VpnGatewayId'] in ids)
+                               and {'Key': 'transitvpc:spoke', 'Value': 'true'} in vpn['Tags']]}
+
+  def describe_vpcs(self, Filters=None, VpcIds=None, **kwargs):
+    self._call('DescribeVpcs')
+    ids = VpcIds or filterValues(Filters, 'vpc-id') or []
+    return {'Vpcs': [self.aws.vpcs[vpc_id] for vpc_id in ids if vpc_id in self.aws.vpcs]}
+
+  def create_customer_gateway(self, **kwargs):
+    self._call('CreateCustomerGateway')
+    return {'CustomerGateway': {'CustomerGatewayId': 'cgw-%s' % kwargs['PublicIp'].replace('.', '')}}
+
+  def create_vpn_connection(self, CustomerGatewayId, VpnGatewayId, TagSpecifications=(), **kwargs):
+    self._call('CreateVpnConnection')
+    tags = [tag for spec in TagSpecifications if spec['ResourceType'] == 'vpn-connection' for tag in spec['Tags']]
+    return {'VpnConnection': self.aws.newVpn(self.region, VpnGatewayId, CustomerGatewayId, tags)}
+
+  def create_tags(self, Resources, Tags):
+    self._call('CreateTags')
+    for vpn in self.aws.vpns.get(self.region, []):
+      if vpn['VpnConnectionId'] in Resources:
+        vpn['Tags'].extend(Tags)
+
+  def delete_vpn_connection(self, VpnConnectionId):
+    self._call('DeleteVpnConnection')
+    with self.aws.lock:
+      self.aws.vpns[self.region] = [vpn for vpn in self.aws.vpns[self.region]
+                                    if vpn['VpnConnectionId'] != VpnConnectionId]
+
+  def delete_customer_gateway(self, CustomerGatewayId):
+    self._call('DeleteCustomerGateway')
+    raise ClientError({'Error': {'Code': 'IncorrectState', 'Message': 'in use'}}, 'DeleteCustomerGateway')
+
+
+class FakeS3(object):
+  def __init__(self, aws):
+    self.aws = aws
+    self.lock = threading.Lock()
+    self.objects = {}
+    self.meta = FakeMeta()
+
+  def _call(self, name):
+    self.aws.counter.add('s3.' + name)
+    time.sleep(self.aws.s3_latency)
+    self.meta.events.emit('after-call.s3.' + name, model=FakeOperation(name), parsed=PARSED)
+
+  def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+    self._call('GetObject')
+    if Key not in self.objects:
+      raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': Key}}, 'GetObject')
+    body, etag, modified = self.objects[Key]
+    if IfNoneMatch == etag:
+      raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'}}, 'GetObject')
+    return {'Body': io.BytesIO(body), 'ETag': etag, 'LastModified': modified, 'ContentLength': len(body)}
+
+  def put_object(self, Body, Bucket, Key, **kwargs):
+    self._call('PutObject')
+    with self.lock:
+      etag = '"%s"' % hashlib.md5(Body).hexdigest()
+      self.objects[Key] = (Body, etag, datetime.datetime.now(datetime.timezone.utc))
+    return {'ETag': etag}
+
+  def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None, MaxKeys=1000, **kwargs):
+    self._call('ListObjectsV2')
+    keys = sorted(key for key in self.objects if key.startswith(Prefix) and key > (ContinuationToken or ''))
+    page = {'KeyCount': min(len(keys), MaxKeys), 'IsTruncated': len(keys) > MaxKeys}
+    if keys:
+      page['Contents'] = [{'Key': key, 'ETag': self.objects[key][1], 'LastModified': self.objects[key][2],
+                           'Size': len(self.objects[key][0])} for key in keys[:MaxKeys]]
+    if page['IsTruncated']:
+      page['NextContinuationToken'] = keys[MaxKeys - 1]
+    return page
+
+  def get_paginator(self, operation):
+    return FakePaginator(self, operation)
+
+  def delete_object(self, Bucket, Key, **kwargs):
+    self._call('DeleteObject')
+    with self.lock:
+      self.objects.pop(Key, None)
+    return {}
+
+
+class FakePaginator(object):
+  def __init__(self, s3, operation):
+    assert operation == 'list_objects_v2', operation
+    self.s3 = s3
+
+  def paginate(self, **kwargs):
+    while True:
+      page = self.s3.list_objects_v2(**kwargs)
+      yield page
+      if not page['IsTruncated']:
+        return
+      kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+
+class Context(object):
+  """The parts of the Lambda context object the poller uses."""
+
+  invoked_function_arn = 'arn:aws:lambda:us-east-1:123456789012:function:bench-vgw-poller'
+
+  def __init__(self, timeout_ms=60000):
+    self.deadline = time.time() + timeout_ms / 1000.0
+
+  def get_remaining_time_in_millis(self):
+    return int((self.deadline - time.time()) * 1000)
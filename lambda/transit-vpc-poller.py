@@ -13,15 +13,22 @@
 
 import boto3
 from botocore.client import Config
-from xml.dom import minidom
 import os
 import logging
 import datetime 
+import functools
+import hashlib
 import sys
+import threading
+import time
 import json
 import urllib.request
 import urllib.parse as urlparse
 import re
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+import transitvpc_codec
+import transitvpc_metrics
 
 log_level = str(os.environ.get('LOG_LEVEL')).upper()
 if log_level not in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
@@ -37,8 +44,83 @@ PIP = str(os.environ.get('PIP'))
 HUB_TAG = str(os.environ.get('HUB_TAG'))
 HUB_TAG_VALUE = str(os.environ.get('HUB_TAG_VALUE'))
 BGP_ASN = int(os.environ.get('BGP_ASN'))
+# Number of regions scanned concurrently (1 scans the regions one at a time)
+SCAN_WORKERS = int(os.environ.get('SCAN_WORKERS', '32'))
+# Per-run budget: VGWs processed per invocation and Lambda time (ms) held back when deciding to stop
+MAX_WORK_ITEMS = int(os.environ.get('MAX_WORK_ITEMS', '100'))
+TIME_RESERVE_MS = int(os.environ.get('TIME_RESERVE_MS', '10000'))
+CHECKPOINT_KEY = bucket_prefix + 'poller-checkpoint.json'
+# TNSR endpoints the spokes are spread over, as a JSON list of {"name", "eip", "pip"}. The configs of an endpoint
+# are written under bucket_prefix + name + '/'. Defaults to the single endpoint CSR1 at EIP/PIP.
+ENDPOINTS = json.loads(os.environ.get('ENDPOINTS') or 'null') or [{'name': 'CSR1', 'eip': EIP, 'pip': PIP}]
+# Index of every VPN config of an endpoint, kept under its prefix, which the TNSR agent polls instead of listing
+# the bucket, and how long (seconds) configs marked for deletion stay in it
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_TOMBSTONE_TTL = int(os.environ.get('MANIFEST_TOMBSTONE_TTL', str(7 * 24 * 3600)))
+# Other accounts whose spoke VGWs are scanned along with this one's, as a comma separated list of account IDs (whose
+# role SPOKE_ROLE_NAME is assumed) or role ARNs
+SPOKE_ACCOUNTS = [account.strip() for account in os.environ.get('SPOKE_ACCOUNTS', '').split(',') if account.strip()]
+SPOKE_ROLE_NAME = os.environ.get('SPOKE_ROLE_NAME', 'TransitVpcSpokeRole')
+# Assumed role credentials are renewed once less than this many seconds of them are left
+CREDENTIAL_REFRESH_S = 300
+
+
+# This function reads the burst size of an EC2 rate limit. A bucket which holds less than one token never lets a
+# call through, so a limit which is on needs a burst of at least 1.
+def burstSize(name, default, rate):
+    burst = int(os.environ.get(name, default))
+    if rate > 0 and burst < 1:
+        raise ValueError('%s must be at least 1 while its rate limit is on, not %s' % (name, burst))
+    return burst
+
+
+# Client side limits on EC2 calls per account and region, as calls per second and burst size. They mirror the token
+# buckets EC2 throttles with, one for Describe* calls and one for the calls which change resources: the same refill
+# rates but half the bucket sizes, leaving room for other tools in the account. A rate of 0 turns a limit off.
+# Throttled calls are still retried up to EC2_MAX_ATTEMPTS times with adaptive backoff.
+EC2_DESCRIBE_RATE = float(os.environ.get('EC2_DESCRIBE_RATE', '20'))
+EC2_DESCRIBE_BURST = burstSize('EC2_DESCRIBE_BURST', '50', EC2_DESCRIBE_RATE)
+EC2_MUTATE_RATE = float(os.environ.get('EC2_MUTATE_RATE', '5'))
+EC2_MUTATE_BURST = burstSize('EC2_MUTATE_BURST', '100', EC2_MUTATE_RATE)
+EC2_MAX_ATTEMPTS = int(os.environ.get('EC2_MAX_ATTEMPTS', '8'))
+# CloudWatch namespace of the metrics printed in Embedded Metric Format at the end of every run (empty turns them off)
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'TransitVPC')
+# CloudTrail events which change whether a VGW is attached to a spoke VPC
+VGW_EVENTS = ('AttachVpnGateway', 'DetachVpnGateway', 'DeleteVpnGateway')
+# Maximum number of values EC2 accepts in a single describe filter
+VPC_LOOKUP_CHUNK = 200
 UUID = ''
 LOG_LEVEL = 'INFO'
+# Credentials of the spoke account roles by role ARN, kept by a warm Lambda container between invocations
+spoke_credentials = {}
+# EC2 clients and their rate limiters by (account, region), also kept between invocations, and the S3 client
+ec2_clients = {}
+ec2_limiters = {}
+s3_client = None
+# Timings, API call counts and gauges of the current run
+metrics = transitvpc_metrics.Metrics()
+
+
+class TokenBucket(object):
+    # Allows bursts of up to burst calls, refilled at rate calls per second. Callers block until a token is free.
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
 
 def getTags(vgwTags):
@@ -48,176 +130,633 @@ def getTags(vgwTags):
     return tags
 
 # This function adds a <transit_vpc_config /> block to an existing XML doc and returns the new XML
-def updateConfigXML(xml, vgwTags, account_id, spoke_subnet, csr_number):
-    xmldoc = minidom.parseString(xml)
-    # Create TransitVPC config xml block
-    transitConfig = xmldoc.createElement("transit_vpc_config")
-    # Create Account ID xml block
-    newXml = xmldoc.createElement("account_id")
-    newXml.appendChild(xmldoc.createTextNode(account_id))
-    transitConfig.appendChild(newXml)
-
-    # Create VPN Endpoint xml block
-    newXml = xmldoc.createElement("vpn_endpoint")
-    newXml.appendChild(xmldoc.createTextNode(csr_number))
-    transitConfig.appendChild(newXml)
-
-    # Create VPN Spoke subnet xml block
-    newXml = xmldoc.createElement("spoke_subnet")
-    newXml.appendChild(xmldoc.createTextNode(spoke_subnet))
-    transitConfig.appendChild(newXml)
-
-    # Create Transit IPSec local INT xml block
-    newXml = xmldoc.createElement("customer_local_ip")
-    newXml.appendChild(xmldoc.createTextNode(PIP))
-    transitConfig.appendChild(newXml)
-
-    # Create status xml block (create = tagged to create spoke, delete = tagged as spoke, but not with the correct spoke tag value)
-    newXml = xmldoc.createElement("status")
+def updateConfigXML(xml, vgwTags, account_id, spoke_subnets, csr_number, local_ip):
+    # Status: create = tagged to create spoke, delete = tagged as spoke, but not with the correct spoke tag value
     if vgwTags[HUB_TAG] == HUB_TAG_VALUE:
-        newXml.appendChild(xmldoc.createTextNode("create"))
+        status = "create"
+    else:
+        status = "delete"
+    # Append the TransitVPC config block to the document EC2 generated, without parsing it. Each CIDR block of the
+    # spoke VPC gets its own <spoke_subnet> element; a VGW no longer attached to a VPC has none.
+    return transitvpc_codec.injectTransitConfig(xml, [
+        ('account_id', account_id),
+        ('vpn_endpoint', csr_number),
+    ] + [('spoke_subnet', spoke_subnet) for spoke_subnet in spoke_subnets] + [
+        ('customer_local_ip', local_ip),
+        ('status', status),
+    ])
+
+
+# This function assigns a new spoke VGW to an endpoint by rendezvous hashing: each endpoint scores the VGW and the
+# highest score wins. The choice only depends on the VGW and the endpoint names, and adding an endpoint only takes
+# the spokes it now scores highest on from the others.
+def pickEndpoint(vgw_id):
+    return max(ENDPOINTS, key=lambda endpoint: hashlib.md5((endpoint['name'] + '/' + vgw_id).encode()).hexdigest())
+
+
+# This function returns the endpoint with the given name. Connections keep the endpoint they were created on, even
+# one which has since been removed from ENDPOINTS.
+def getEndpoint(name):
+    for endpoint in ENDPOINTS:
+        if endpoint['name'] == name:
+            return endpoint
+    return {'name': name, 'eip': EIP, 'pip': PIP}
+
+
+def endpointPrefix(name):
+    return bucket_prefix + name + '/'
+
+
+def paginate(method, key, **kwargs):
+    # Yield the items under key from an EC2 describe call, following NextToken as a stream
+    while True:
+        response = method(**kwargs)
+        for item in response.get(key, []):
+            yield item
+        next_token = response.get('NextToken')
+        if not next_token:
+            return
+        kwargs['NextToken'] = next_token
+
+
+# This function returns the CIDR blocks associated with each of the given VPCs (the primary one first), looked up in
+# bulk
+def getVpcCidrs(ec2, vpc_ids):
+    vpc_cidrs = {}
+    # A vpc-id filter (rather than VpcIds) skips VPCs which no longer exist instead of failing the whole call
+    for i in range(0, len(vpc_ids), VPC_LOOKUP_CHUNK):
+        for vpc in paginate(ec2.describe_vpcs, 'Vpcs', Filters=[
+            {'Name': 'vpc-id', 'Values': vpc_ids[i:i + VPC_LOOKUP_CHUNK]}
+        ]):
+            cidrs = [vpc['CidrBlock']]
+            for association in vpc.get('CidrBlockAssociationSet', []):
+                if association['CidrBlockState']['State'] == 'associated' and association['CidrBlock'] not in cidrs:
+                    cidrs.append(association['CidrBlock'])
+            vpc_cidrs[vpc['VpcId']] = cidrs
+    return vpc_cidrs
+
+
+def getVpcId(vgw):
+    attachments = vgw.get('VpcAttachments', [])
+    if attachments:
+        return attachments[0]['VpcId']
+    return None
+
+
+# This function discovers the VGWs in one region that need VPN connections created or removed, or whose configs may
+# need other CIDR blocks, and returns them as work items (only the VGWs listed in vgw_ids are looked at when it is given)
+def scanRegion(account_id, region_id, ec2, vgw_ids=None):
+    log.debug('Checking region: %s in account %s', region_id, account_id)
+    vpn_filters = [
+        {'Name': 'state', 'Values': ['available', 'pending', 'deleting']},
+        {'Name': 'tag:' + HUB_TAG, 'Values': [HUB_TAG_VALUE]}
+    ]
+    vgw_filters = [
+        {'Name': 'state', 'Values': ['available', 'attached', 'detached']}
+    ]
+    if vgw_ids is not None:
+        vpn_filters.append({'Name': 'vpn-gateway-id', 'Values': vgw_ids})
+        vgw_filters.append({'Name': 'vpn-gateway-id', 'Values': vgw_ids})
+
+    # Get list of Transit VPC tagged VPN connections in the region, indexed by the VGW they belong to
+    vpns_by_vgw = {}
+    for vpn in paginate(ec2.describe_vpn_connections, 'VpnConnections', Filters=vpn_filters):
+        vpns_by_vgw.setdefault(vpn['VpnGatewayId'], []).append(vpn)
+
+    work = []
+    # Process all the VGWs in the region as they are paged in
+    for vgw in paginate(ec2.describe_vpn_gateways, 'VpnGateways', Filters=vgw_filters):
+        # Check to see if the VGW has tags, if not, then we should skip it
+        if vgw.get('Tags', '') == '':
+            continue
+
+        # Put all of the VGW tags into a dict for easier processing
+        vgwTags = getTags(vgw['Tags'])
+        # Configure HUB_TAG if it is not set already (for untagged VGWs)
+        vgwTags[HUB_TAG] = vgwTags.get(HUB_TAG, '')
+
+        # Determine if VGW is tagged as a spoke
+        spoke_vgw = False
+        if vgwTags[HUB_TAG] == HUB_TAG_VALUE:
+            spoke_vgw = True
+
+        # Check to see if the VGW already has Transit VPC VPN Connections
+        vgw_vpns = vpns_by_vgw.get(vgw['VpnGatewayId'], [])
+        vpn_existing = len(vgw_vpns) > 0
+
+        # Need to create VPN connections if this is a spoke VGW and no VPN connections already exist
+        if spoke_vgw and not vpn_existing:
+            work.append({'action': 'create', 'account_id': account_id, 'region_id': region_id, 'ec2': ec2, 'vgw': vgw,
+                         'vgwTags': vgwTags})
+
+        # Need to delete VPN connections if this is no longer a spoke VPC (tagged for spoke, but tag != spoke tag value) but Transit VPC connections exist
+        if not spoke_vgw and vpn_existing:
+            work.append({'action': 'delete', 'account_id': account_id, 'region_id': region_id, 'ec2': ec2, 'vgw': vgw,
+                         'vgwTags': vgwTags, 'vpns': vgw_vpns})
+
+        # A spoke with VPN connections may need its configs rewritten if CIDR blocks were added to its VPC or removed
+        # from it since; applyPlan drops the spokes whose configs are up to date
+        available = [vpn for vpn in vgw_vpns if vpn['State'] == 'available']
+        if spoke_vgw and available:
+            work.append({'action': 'update', 'account_id': account_id, 'region_id': region_id, 'ec2': ec2, 'vgw': vgw,
+                         'vgwTags': vgwTags, 'vpns': available})
+
+    # Look up the spoke subnets of all the VGWs to process with one bulk call
+    vpc_ids = sorted(set(getVpcId(item['vgw']) for item in work if getVpcId(item['vgw'])))
+    vpc_cidrs = getVpcCidrs(ec2, vpc_ids) if vpc_ids else {}
+    for item in work:
+        item['spoke_subnets'] = vpc_cidrs.get(getVpcId(item['vgw']))
+    # A spoke whose VGW is no longer attached to a VPC keeps the configs it has
+    return [item for item in work if item['action'] != 'update' or item['spoke_subnets'] is not None]
+
+
+def spokeRoleArn(account):
+    if account.startswith('arn:'):
+        return account
+    return 'arn:aws:iam::' + account + ':role/' + SPOKE_ROLE_NAME
+
+
+# This function returns the credentials of every spoke account by account ID. Roles are assumed concurrently and
+# only when the container has no credentials for them which are valid for CREDENTIAL_REFRESH_S seconds more; an
+# account whose role cannot be assumed is left out of this run.
+def getSpokeCredentials():
+    role_arns = [spokeRoleArn(account) for account in SPOKE_ACCOUNTS]
+
+    def fresh(role_arn):
+        credentials = spoke_credentials.get(role_arn)
+        if credentials is None:
+            return False
+        expiration = credentials['Expiration']
+        return expiration - datetime.datetime.now(expiration.tzinfo) > datetime.timedelta(seconds=CREDENTIAL_REFRESH_S)
+
+    stale = [role_arn for role_arn in role_arns if not fresh(role_arn)]
+    if stale:
+        sts = boto3.client('sts')
+        metrics.instrumentClient(sts)
+
+        def assume(role_arn):
+            try:
+                return role_arn, sts.assume_role(RoleArn=role_arn, RoleSessionName='transit-vpc-poller')['Credentials']
+            except Exception:
+                log.exception('Failed to assume %s, skipping its account for this run', role_arn)
+                return role_arn, None
+
+        workers = max(1, min(SCAN_WORKERS, len(stale)))
+        with metrics.timer('assume_roles'), ThreadPoolExecutor(max_workers=workers) as executor:
+            for role_arn, credentials in executor.map(assume, stale):
+                if credentials is not None:
+                    spoke_credentials[role_arn] = credentials
+    # The account ID is the fifth field of the role ARN: arn:aws:iam::<account>:role/<name>
+    return dict((role_arn.split(':')[4], spoke_credentials[role_arn]) for role_arn in role_arns
+                if role_arn in spoke_credentials)
+
+
+# This function takes a token from the bucket an EC2 call counts against before botocore sends it
+def rateLimit(limiters, model, **kwargs):
+    describe, mutate = limiters
+    bucket = describe if model.name.startswith('Describe') else mutate
+    if bucket is not None:
+        with metrics.timer('ec2_rate_limit_wait'):
+            bucket.acquire()
+
+
+# This function returns the EC2 client of an account and region. Clients are built once per container and reused by
+# every invocation (a client of a spoke account is rebuilt when its role has been assumed again), and all the clients
+# of an account and region share the same rate limiters.
+def getEc2Client(account_id, region_id, credentials=None):
+    key = (account_id, region_id)
+    access_key = credentials['AccessKeyId'] if credentials else None
+    cached = ec2_clients.get(key)
+    if cached is not None and cached[0] == access_key:
+        return cached[1]
+    config = Config(retries={'mode': 'adaptive', 'max_attempts': EC2_MAX_ATTEMPTS}, max_pool_connections=SCAN_WORKERS)
+    if credentials is None:
+        ec2 = boto3.client('ec2', region_name=region_id, config=config)
+    else:
+        ec2 = boto3.client('ec2', region_name=region_id, config=config,
+                           aws_access_key_id=credentials['AccessKeyId'],
+                           aws_secret_access_key=credentials['SecretAccessKey'],
+                           aws_session_token=credentials['SessionToken'])
+    if key not in ec2_limiters:
+        ec2_limiters[key] = (TokenBucket(EC2_DESCRIBE_RATE, EC2_DESCRIBE_BURST) if EC2_DESCRIBE_RATE > 0 else None,
+                             TokenBucket(EC2_MUTATE_RATE, EC2_MUTATE_BURST) if EC2_MUTATE_RATE > 0 else None)
+    ec2.meta.events.register('before-call.ec2', functools.partial(rateLimit, ec2_limiters[key]))
+    metrics.instrumentClient(ec2)
+    ec2_clients[key] = (access_key, ec2)
+    return ec2
+
+
+# This function returns the S3 client, which is also kept by the container between invocations
+def getS3Client():
+    global s3_client
+    if s3_client is None:
+        s3_client = boto3.client('s3', config=Config(signature_version='s3v4'))
+        metrics.instrumentClient(s3_client)
+    return s3_client
+
+
+# This function fans the per-region discovery out over a bounded worker pool and merges the results into one plan.
+# targets is a list of (account_id, region_id, vgw_ids) triples, vgw_ids is None to scan the whole region, and
+# credentials holds the credentials of the accounts other than this function's own.
+def scanRegions(targets, credentials):
+    # Clients are looked up here rather than in the workers since the default boto3 session is not thread safe
+    clients = [(account_id, region_id, vgw_ids, getEc2Client(account_id, region_id, credentials.get(account_id)))
+               for account_id, region_id, vgw_ids in targets]
+
+    def scan(args):
+        account_id, region_id, vgw_ids, ec2 = args
+        try:
+            with metrics.timer('scan_region'):
+                return scanRegion(account_id, region_id, ec2, vgw_ids)
+        except Exception:
+            log.exception('Failed to scan region %s in account %s, skipping it for this run', region_id, account_id)
+            return []
+
+    plan = []
+    workers = max(1, min(SCAN_WORKERS, len(clients)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # map() keeps the order of the targets so the plan is deterministic
+        for work in executor.map(scan, clients):
+            plan.extend(work)
+    return plan
+
+
+def configKey(endpoint_name, region_id, vpn_id):
+    return endpointPrefix(endpoint_name) + region_id + '-' + vpn_id + '.conf'
+
+
+# This function puts a VPN config in S3 and returns its ETag
+def putConfig(s3, key, vpn_config):
+    with metrics.timer('s3_put'):
+        response = s3.put_object(
+            Body=str.encode(vpn_config),
+            Bucket=bucket_name,
+            Key=key,
+            ACL='bucket-owner-full-control',
+        )
+    return response.get('ETag')
+
+
+# This function creates the VPN connection from a newly tagged spoke VGW to the endpoint it is assigned to
+def createVpn(item, s3, manifests):
+    ec2 = item['ec2']
+    vgw = item['vgw']
+    region_id = item['region_id']
+    log.info('Found a new VGW (%s) which needs VPN connections.', vgw['VpnGatewayId'])
+    # Without an attached VPC there is no spoke subnet to route to yet
+    spoke_subnets = item['spoke_subnets']
+    if spoke_subnets is None:
+        log.warning('VGW %s is not attached to a VPC, skipping it for now', vgw['VpnGatewayId'])
+        return
+    endpoint = pickEndpoint(vgw['VpnGatewayId'])
+    # Create the Customer Gateway of the endpoint (created if it does not exist, otherwise the API call is ignored)
+    log.debug('Creating Customer Gateway for %s with IP %s', endpoint['name'], endpoint['eip'])
+    cg = ec2.create_customer_gateway(Type='ipsec.1', PublicIp=endpoint['eip'], BgpAsn=BGP_ASN, TagSpecifications=[{
+        'ResourceType': 'customer-gateway',
+        'Tags': [{'Key': 'Name', 'Value': 'Transit VPC ' + endpoint['name']}]
+    }])
+    log.info('Created Customer Gateway: %s', cg['CustomerGateway']['CustomerGatewayId'])
+
+    # Create the VPN connection, tagged as it is created so that a failure can not leave an untagged connection
+    # behind which the next scan would not recognise
+    vpn = ec2.create_vpn_connection(Type='ipsec.1', CustomerGatewayId=cg['CustomerGateway']['CustomerGatewayId'],
+                                    VpnGatewayId=vgw['VpnGatewayId'], Options={'StaticRoutesOnly': True},
+                                    TagSpecifications=[{
+                                        'ResourceType': 'vpn-connection',
+                                        'Tags': [
+                                            {'Key': 'Name', 'Value': vgw['VpnGatewayId'] + '-to-Transit-VPC ' + endpoint['name']},
+                                            {'Key': HUB_TAG, 'Value': HUB_TAG_VALUE},
+                                            {'Key': 'transitvpc:endpoint', 'Value': endpoint['name']}
+                                        ]
+                                    }])
+    log.info('Created VPN connection %s to %s', vpn['VpnConnection']['VpnConnectionId'], endpoint['name'])
+
+    # Retrieve VPN configuration
+    vpn_config = ec2.describe_vpn_connections(VpnConnectionIds=[vpn['VpnConnection']['VpnConnectionId']])
+    vpn_config = vpn_config['VpnConnections'][0]['CustomerGatewayConfiguration']
+    # Update VPN configuration XML with transit VPC specific configuration info for this connection
+    with metrics.timer('xml_serialize'):
+        vpn_config = updateConfigXML(vpn_config, item['vgwTags'], item['account_id'], spoke_subnets, endpoint['name'],
+                                     endpoint['pip'])
+    # Put the config under the endpoint's prefix in S3
+    key = configKey(endpoint['name'], region_id, vpn['VpnConnection']['VpnConnectionId'])
+    etag = putConfig(s3, key, vpn_config)
+    recordConfig(getManifest(s3, manifests, endpoint['name']), key, 'create', etag, subnets=spoke_subnets)
+    log.debug('Pushed VPN configuration to S3...')
+
+
+# This function marks the VPN connections of a VGW which is no longer a spoke for deletion and removes them
+def deleteVpn(item, s3, manifests):
+    ec2 = item['ec2']
+    vgw = item['vgw']
+    region_id = item['region_id']
+    log.info('Found old VGW (%s) with VPN connections to remove.', vgw['VpnGatewayId'])
+    spoke_subnets = item['spoke_subnets'] or []
+    for vpn in item['vpns']:
+        # Put the VPN tags into a dict for easier processing
+        vpnTags = getTags(vpn['Tags'])
+        endpoint = getEndpoint(vpnTags.get('transitvpc:endpoint', 'CSR1'))
+        # Need to get VPN configuration to remove from the endpoint
+        vpn_config = vpn['CustomerGatewayConfiguration']
+        # Update VPN configuration XML with transit VPC specific configuration info for this connection
+        with metrics.timer('xml_serialize'):
+            vpn_config = updateConfigXML(vpn_config, item['vgwTags'], item['account_id'], spoke_subnets,
+                                         endpoint['name'], endpoint['pip'])
+
+        key = configKey(endpoint['name'], region_id, vpn['VpnConnectionId'])
+        etag = putConfig(s3, key, vpn_config)
+        recordConfig(getManifest(s3, manifests, endpoint['name']), key, 'delete', etag)
+        log.debug('Pushed %s configuration to S3.', endpoint['name'])
+        # Now we need to delete the VPN connection
+        ec2.delete_vpn_connection(VpnConnectionId=vpn['VpnConnectionId'])
+        log.info('Deleted VPN connection (%s) to %s', vpn['VpnConnectionId'], endpoint['name'])
+        # Attempt to clean up the CGW. This will only succeed if the CGW has no VPN connections are deleted
+        try:
+            ec2.delete_customer_gateway(CustomerGatewayId=vpn['CustomerGatewayId'])
+            log.info("Cleaned up %s since it has no VPN connections left", vpn['CustomerGatewayId'])
+        except:
+            log.debug("%s still has existing VPN connections", vpn['CustomerGatewayId'])
+
+
+# This function tells whether the configs of a spoke's VPN connections were written with other CIDR blocks than its
+# VPC has now. The manifest records the blocks of every config the poller has written; a config without them (written
+# by an older version, or found by a listing) is rewritten once.
+def subnetsChanged(item, s3, manifests):
+    for vpn in item['vpns']:
+        endpoint_name = getTags(vpn['Tags']).get('transitvpc:endpoint', 'CSR1')
+        config = getManifest(s3, manifests, endpoint_name)['configs'].get(
+            configKey(endpoint_name, item['region_id'], vpn['VpnConnectionId']))
+        if config is None or config.get('subnets') != item['spoke_subnets']:
+            return True
+    return False
+
+
+# This function rewrites the configs of a spoke's VPN connections with the CIDR blocks its VPC has now
+def updateVpn(item, s3, manifests):
+    vgw = item['vgw']
+    spoke_subnets = item['spoke_subnets']
+    log.info('The VPC of %s has the CIDR blocks %s now, rewriting its VPN configs', vgw['VpnGatewayId'],
+             ', '.join(spoke_subnets))
+    for vpn in item['vpns']:
+        endpoint = getEndpoint(getTags(vpn['Tags']).get('transitvpc:endpoint', 'CSR1'))
+        with metrics.timer('xml_serialize'):
+            vpn_config = updateConfigXML(vpn['CustomerGatewayConfiguration'], item['vgwTags'], item['account_id'],
+                                         spoke_subnets, endpoint['name'], endpoint['pip'])
+        key = configKey(endpoint['name'], item['region_id'], vpn['VpnConnectionId'])
+        etag = putConfig(s3, key, vpn_config)
+        recordConfig(getManifest(s3, manifests, endpoint['name']), key, 'create', etag, subnets=spoke_subnets)
+
+
+# This function returns the manifest of the VPN configs of an endpoint. The first run after an upgrade builds it
+# from a listing of the configs already under the endpoint's prefix; their status is only known once they are
+# rewritten. A manifest which is built again (e.g. after it was deleted) starts its generations over, so each one
+# gets a new epoch which tells the agent to compare its cache with every config again.
+def loadManifest(s3, endpoint_name):
+    prefix = endpointPrefix(endpoint_name)
+    try:
+        with metrics.timer('s3_get'):
+            return json.loads(s3.get_object(Bucket=bucket_name, Key=prefix + MANIFEST_FILE)['Body'].read())
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+            raise
+    log.info('No manifest yet, building it from the configs under %s', prefix)
+    manifest = {'version': 1, 'epoch': datetime.datetime.utcnow().isoformat(), 'generation': 0, 'configs': {}}
+    for obj in listConfigs(s3, prefix):
+        recordConfig(manifest, obj['Key'], None, obj['ETag'], obj['LastModified'].isoformat())
+    return manifest
+
+
+# This function returns the VPN config objects under prefix
+def listConfigs(s3, prefix):
+    paginator = s3.get_paginator('list_objects_v2')
+    with metrics.timer('s3_list'):
+        return [obj for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+                for obj in page.get('Contents', []) if obj['Key'].endswith('.conf')]
+
+
+# This function records the configs under an endpoint's prefix which its manifest lacks or lists with another ETag.
+# They are left behind by a run which wrote configs but failed or was stopped before it saved the manifest; their
+# status is only known once they are read. Configs of unknown status which are no longer there have been removed by
+# the agent and are dropped. Returns whether the manifest changed.
+def repairManifest(s3, endpoint_name, manifest):
+    repaired = 0
+    listed = set()
+    for obj in listConfigs(s3, endpointPrefix(endpoint_name)):
+        listed.add(obj['Key'])
+        config = manifest['configs'].get(obj['Key'])
+        if config is None or config['etag'] != obj['ETag']:
+            recordConfig(manifest, obj['Key'], None, obj['ETag'], obj['LastModified'].isoformat())
+            repaired += 1
+    if repaired:
+        log.warning('Recorded %s configs under %s which were missing from the manifest', repaired,
+                    endpointPrefix(endpoint_name))
+    removed = [key for key, config in manifest['configs'].items() if config['status'] is None and key not in listed]
+    for key in removed:
+        del manifest['configs'][key]
+    return bool(repaired or removed)
+
+
+# This function returns the manifest of an endpoint, loading it the first time the run writes to the endpoint
+def getManifest(s3, manifests, endpoint_name):
+    if endpoint_name not in manifests:
+        manifest = loadManifest(s3, endpoint_name)
+        manifests[endpoint_name] = (manifest, manifest['generation'])
+    return manifests[endpoint_name][0]
+
+
+# This function records a config the poller has just written under the next generation of the manifest, with the
+# spoke subnets it lists when they are known
+def recordConfig(manifest, key, status, etag, updated=None, subnets=None):
+    manifest['generation'] += 1
+    manifest['configs'][key] = {
+        'status': status,
+        'generation': manifest['generation'],
+        'etag': etag,
+        'updated': updated or datetime.datetime.utcnow().isoformat(),
+    }
+    if subnets is not None:
+        manifest['configs'][key]['subnets'] = list(subnets)
+
+
+# This function drops configs marked for deletion more than MANIFEST_TOMBSTONE_TTL seconds ago. By then the agent
+# has removed the tunnel, and an agent which still has it cached treats a config missing from the manifest as deleted.
+def pruneManifest(manifest):
+    cutoff = (datetime.datetime.utcnow() - datetime.timedelta(seconds=MANIFEST_TOMBSTONE_TTL)).isoformat()
+    expired = [key for key, config in manifest['configs'].items()
+               if config['status'] == 'delete' and config['updated'] < cutoff]
+    for key in expired:
+        del manifest['configs'][key]
+    return len(expired)
+
+
+def saveManifest(s3, endpoint_name, manifest):
+    manifest['updated'] = datetime.datetime.utcnow().isoformat()
+    with metrics.timer('s3_put'):
+        s3.put_object(
+            Body=str.encode(json.dumps(manifest, separators=(',', ':'), sort_keys=True)),
+            Bucket=bucket_name,
+            Key=endpointPrefix(endpoint_name) + MANIFEST_FILE,
+            ACL='bucket-owner-full-control',
+            ContentType='application/json',
+        )
+
+
+def workKey(item):
+    return item['account_id'] + '/' + item['region_id'] + '/' + item['vgw']['VpnGatewayId'] + '/' + item['action']
+
+
+# This function returns the work keys left over by the previous run
+def loadCheckpoint(s3):
+    try:
+        with metrics.timer('s3_get'):
+            checkpoint = json.loads(s3.get_object(Bucket=bucket_name, Key=CHECKPOINT_KEY)['Body'].read())
+    except ClientError as e:
+        log.debug('No checkpoint to resume from: %s', e)
+        return []
+    return checkpoint.get('pending', [])
+
+
+# This function records the work keys that this run did not get to, so the next run resumes with them
+def saveCheckpoint(s3, pending):
+    with metrics.timer('s3_put'):
+        s3.put_object(
+            Body=str.encode(json.dumps({'pending': pending, 'updated': datetime.datetime.utcnow().isoformat()})),
+            Bucket=bucket_name,
+            Key=CHECKPOINT_KEY,
+            ACL='bucket-owner-full-control',
+        )
+
+
+# This function processes the plan until it is done or the per-run budget is spent and checkpoints what is left.
+# A partial plan (from an event) only covers some VGWs, so the rest of the checkpoint is kept as it is.
+def applyPlan(plan, s3, context, partial=False):
+    checkpoint = loadCheckpoint(s3)
+    # Manifests of the endpoints this run writes to, with the generation they were loaded at
+    manifests = {}
+    # Spokes with VPN connections are only processed when their CIDR blocks have changed
+    plan = [item for item in plan if item['action'] != 'update' or subnetsChanged(item, s3, manifests)]
+    # Work left over by the previous run goes first, in the order it was left
+    order = dict((key, position) for position, key in enumerate(checkpoint))
+    plan = sorted(plan, key=lambda item: order.get(workKey(item), len(order)))
+
+    processed = 0
+    failed = []
+    for item in plan:
+        if processed >= MAX_WORK_ITEMS or context.get_remaining_time_in_millis() < TIME_RESERVE_MS:
+            break
+        processed += 1
+        try:
+            with metrics.timer(item['action'] + '_vpn'):
+                if item['action'] == 'create':
+                    createVpn(item, s3, manifests)
+                elif item['action'] == 'update':
+                    updateVpn(item, s3, manifests)
+                else:
+                    deleteVpn(item, s3, manifests)
+        except Exception:
+            log.exception('Failed to %s VPN connections for %s', item['action'], item['vgw']['VpnGatewayId'])
+            metrics.count('failed_items', action=item['action'])
+            failed.append(workKey(item))
+
+    # Items that failed are retried after the ones this run did not reach
+    pending = [workKey(item) for item in plan[processed:]] + failed
+    if partial:
+        planned = set(workKey(item) for item in plan)
+        pending += [key for key in checkpoint if key not in planned]
+    log.info('Processed %s of %s VGWs, %s left for the next run', processed - len(failed), len(plan), len(pending))
+    for action in ('create', 'update', 'delete'):
+        metrics.gauge('planned_' + action + 's', sum(1 for item in plan if item['action'] == action))
+        metrics.gauge('pending_' + action + 's', sum(1 for key in pending if key.endswith('/' + action)))
+    # A full sweep also checks every endpoint's manifest against the configs under its prefix
+    repaired = set()
+    if not partial:
+        for endpoint in ENDPOINTS:
+            if repairManifest(s3, endpoint['name'], getManifest(s3, manifests, endpoint['name'])):
+                repaired.add(endpoint['name'])
+    # The function runs with a reserved concurrency of 1, so this run is the only writer of the manifests
+    for endpoint_name, (manifest, generation) in sorted(manifests.items()):
+        if (pruneManifest(manifest) or manifest['generation'] != generation or 'updated' not in manifest
+                or endpoint_name in repaired):
+            saveManifest(s3, endpoint_name, manifest)
+    if pending or checkpoint:
+        saveCheckpoint(s3, pending)
+
+
+# This function returns the VGWs named in an EC2 tag change or VGW attach/detach event, grouped by region,
+# or None when the event asks for a full sweep (scheduled events and anything else)
+def getEventTargets(event):
+    vgw_ids = {}
+    if event.get('source') == 'aws.tag' and event.get('detail-type') == 'Tag Change on Resource':
+        # Tag changes name the VGW by ARN: arn:aws:ec2:<region>:<account>:vpn-gateway/<vgw-id>
+        for arn in event.get('resources', []):
+            parts = arn.split(':')
+            if len(parts) == 6 and parts[5].startswith('vpn-gateway/'):
+                vgw_ids.setdefault((parts[4], parts[3]), set()).add(parts[5].split('/', 1)[1])
+    elif event.get('source') == 'aws.ec2' and event.get('detail-type') == 'AWS API Call via CloudTrail':
+        detail = event.get('detail', {})
+        request = detail.get('requestParameters') or {}
+        target = (detail.get('recipientAccountId', event.get('account')), detail.get('awsRegion', event.get('region')))
+        if detail.get('eventName') in VGW_EVENTS and request.get('vpnGatewayId'):
+            vgw_ids.setdefault(target, set()).add(request['vpnGatewayId'])
+        elif detail.get('eventName') in ('CreateTags', 'DeleteTags'):
+            for resource in request.get('resourcesSet', {}).get('items', []):
+                if resource.get('resourceId', '').startswith('vgw-'):
+                    vgw_ids.setdefault(target, set()).add(resource['resourceId'])
     else:
-        newXml.appendChild(xmldoc.createTextNode("delete"))
-    transitConfig.appendChild(newXml)
+        return None
+    return [(account_id, region_id, sorted(ids)) for (account_id, region_id), ids in sorted(vgw_ids.items())]
 
-    # Add transit config to XML
-    xmldoc.childNodes[0].appendChild(transitConfig)
-    return str(xmldoc.toxml())
+
+# This function prints the metrics of the run as CloudWatch Embedded Metric Format documents, which CloudWatch Logs
+# turns into metrics of the METRICS_NAMESPACE namespace with the function name as dimension
+def publishMetrics(context):
+    if not METRICS_NAMESPACE:
+        return
+    function_name = context.invoked_function_arn.split(':')[6]
+    for document in metrics.emf(METRICS_NAMESPACE, {'FunctionName': function_name}):
+        print(json.dumps(document, separators=(',', ':')))
 
 
 def lambda_handler(event, context):
+    metrics.reset()
+    try:
+        with metrics.timer('run'):
+            poll(event, context)
+    finally:
+        publishMetrics(context)
+
+
+def poll(event, context):
     # Figure out the account number by parsing this function's ARN
-    account_id = re.findall(':(\d+):', context.invoked_function_arn)[0]
-    # Retrieve Transit VPC configuration from transit_vpn_config.txt
-    s3 = boto3.client('s3', config=Config(signature_version='s3v4'))
-    log.info('Getting config file %s/%s%s', bucket_name, bucket_prefix)
-
-    log.info('Retrieved IP of transit VPN gateways: %s, %s', EIP)
-    # Use this variable to determine if a VGW has been processed so we will only process one VGW per run (one per minute)
-    processed_vgw = False
-    # Get list of regions so poller can look for VGWs in all regions
-    ec2 = boto3.client('ec2', region_name='us-east-1')
-    regions = ec2.describe_regions()    
-    for region in regions['Regions']:
-        # Get region name for the current region
-        region_id = region['RegionName']
-        log.debug('Checking region: %s', region_id)
-        # Create EC2 connection to this region to get list of VGWs
-        ec2 = boto3.client('ec2', region_name=region_id)
-        # Get list of all VGWs in the region
-        vgws = ec2.describe_vpn_gateways(Filters=[
-            {'Name': 'state', 'Values': ['available', 'attached', 'detached']}
-        ])
-        # Get list of Transit VPC tagged VPN connections in the region as well
-        vpns = ec2.describe_vpn_connections(Filters=[
-            {'Name': 'state', 'Values': ['available', 'pending', 'deleting']},
-            {'Name': 'tag:' + HUB_TAG, 'Values': [HUB_TAG_VALUE]}
-        ])
-
-        # Process all the VGWs in the region
-        for vgw in vgws['VpnGateways']:
-            # Check to see if the VGW has tags, if not, then we should skip it
-            if vgw.get('Tags', '') == '':
-                continue
-
-            # Put all of the VGW tags into a dict for easier processing
-            vgwTags = getTags(vgw['Tags'])
-            # Configure HUB_TAG if it is not set already (for untagged VGWs)
-            vgwTags[HUB_TAG] = vgwTags.get(HUB_TAG, '')
-
-            # Determine if VGW is tagged as a spoke
-            spoke_vgw = False
-            if vgwTags[HUB_TAG] == HUB_TAG_VALUE:
-              spoke_vgw = True
-
-            # Check to see if the VGW already has Transit VPC VPN Connections
-            vpn_existing = False
-            for vpn in vpns['VpnConnections']:
-              if vpn['VpnGatewayId'] == vgw['VpnGatewayId']:
-                  vpn_existing = True
-                  break
-
-            # Need to create VPN connections if this is a spoke VGW and no VPN connections already exist
-            if spoke_vgw and not vpn_existing:
-                log.info('Found a new VGW (%s) which needs VPN connections.', vgw['VpnGatewayId'])
-                # Create Customer Gateways (will create CGWs if they do not exist, otherwise, the API calls are ignored)
-                log.debug('Creating Customer Gateways with IP %s, %s', EIP)
-                cg1 = ec2.create_customer_gateway(Type='ipsec.1', PublicIp=EIP, BgpAsn=BGP_ASN)
-                ec2.create_tags(Resources=[cg1['CustomerGateway']['CustomerGatewayId']],
-                                Tags=[{'Key': 'Name', 'Value': 'Transit VPC Endpoint1'}])
-                log.info('Created Customer Gateways: %s, %s', cg1['CustomerGateway']['CustomerGatewayId'])
-
-                # Create and tag first VPN connection
-                vpn1 = ec2.create_vpn_connection(Type='ipsec.1', CustomerGatewayId=cg1['CustomerGateway']['CustomerGatewayId'],
-                                                VpnGatewayId=vgw['VpnGatewayId'], Options={'StaticRoutesOnly': True})
-
-                ec2.create_tags(Resources=[vpn1['VpnConnection']['VpnConnectionId']],
-                                Tags=[
-                                    {'Key': 'Name', 'Value': vgw['VpnGatewayId'] + '-to-Transit-VPC CSR1'},
-                                    {'Key': HUB_TAG, 'Value': HUB_TAG_VALUE},
-                                    {'Key': 'transitvpc:endpoint', 'Value': 'CSR1'}
-                                ])
-                log.info('Created VPN connections: %s, %s', vpn1['VpnConnection']['VpnConnectionId'])
-
-                # Retrieve VPN configuration
-                vpn_config1 = ec2.describe_vpn_connections(VpnConnectionIds=[vpn1['VpnConnection']['VpnConnectionId']])
-                vpn_config1 = vpn_config1['VpnConnections'][0]['CustomerGatewayConfiguration']
-                # Spoke subnet
-                spoke_subnet = ec2.describe_vpcs(VpcIds=[vgw['VpcAttachments'][0]['VpcId']])['Vpcs'][0]['CidrBlock']
-                # Update VPN configuration XML with transit VPC specific configuration info for this connection
-                vpn_config1 = updateConfigXML(vpn_config1, vgwTags, account_id, spoke_subnet, 'CSR1')
-                # Put CSR1 config in S3
-                s3.put_object(
-                    Body=str.encode(vpn_config1),
-                    Bucket=bucket_name,
-                    Key=bucket_prefix + 'CSR1/' + region_id + '-' + vpn1['VpnConnection']['VpnConnectionId'] + '.conf',
-                    ACL='bucket-owner-full-control',
-                )
-                log.debug('Pushed VPN configurations to S3...')
-                processed_vgw = True
-
-            # Need to delete VPN connections if this is no longer a spoke VPC (tagged for spoke, but tag != spoke tag value) but Transit VPC connections exist
-            if not spoke_vgw and vpn_existing:
-                log.info('Found old VGW (%s) with VPN connections to remove.', vgw['VpnGatewayId'])
-                # We need to go through the region's VPN connections to find the ones to delete
-                for vpn in vpns['VpnConnections']:
-                    if vpn['VpnGatewayId'] == vgw['VpnGatewayId']:
-                        # Put the VPN tags into a dict for easier processing
-                        vpnTags = getTags(vpn['Tags'])
-                        if vpnTags['transitvpc:endpoint'] == 'CSR1':
-                            csrNum = '1'
-                        else:
-                            csrNum = '2'
-                        # Need to get VPN configuration to remove from CSR
-                        vpn_config = vpn['CustomerGatewayConfiguration']
-                        # Spoke subnet
-                        spoke_subnet = ec2.describe_vpcs(
-                            VpcIds=[vgw['VpcAttachments'][0]['VpcId']])['Vpcs'][0]['CidrBlock']
-                        # Update VPN configuration XML with transit VPC specific configuration info for this connection
-                        vpn_config = updateConfigXML(vpn_config, vgwTags, account_id, spoke_subnet,
-                                                     vpnTags['transitvpc:endpoint'])
-
-                        s3.put_object(
-                            Body=str.encode(vpn_config),
-                            Bucket=bucket_name,
-                            Key=bucket_prefix + 'CSR' + csrNum + '/' + region_id + '-' + vpn['VpnConnectionId'] + '.conf',
-                            ACL='bucket-owner-full-control',
-                        )
-                        log.debug('Pushed CSR%s configuration to S3.', csrNum)
-                        # Now we need to delete the VPN connection
-                        ec2.delete_vpn_connection(VpnConnectionId=vpn['VpnConnectionId'])
-                        log.info('Deleted VPN connection (%s) to CSR%s', vpn['VpnConnectionId'], csrNum)
-                        # Attempt to clean up the CGW. This will only succeed if the CGW has no VPN connections are deleted
-                        try:
-                            ec2.delete_customer_gateway(CustomerGatewayId=vpn['CustomerGatewayId'])
-                            log.info("Cleaned up %s since it has no VPN connections left", vpn['CustomerGatewayId'])
-                        except:
-                            log.debug("%s still has existing VPN connections", vpn['CustomerGatewayId'])
-
-            # If a VGW has been processed, then we need to break out of VGW processing
-            if processed_vgw:
-                break
-
-        # If a VGW has been processed, then we need to break out of region processing
-        if processed_vgw:
-            break
+    account_id = re.findall(r':(\d+):', context.invoked_function_arn)[0]
+    s3 = getS3Client()
+    log.info('Writing VPN configs to %s/%s for the transit VPN endpoints %s', bucket_name, bucket_prefix,
+             ', '.join('%s (%s)' % (endpoint['name'], endpoint['eip']) for endpoint in ENDPOINTS))
+    # This account is scanned with the function's own role, the spoke accounts with their assumed roles
+    credentials = getSpokeCredentials()
+    accounts = [account_id] + sorted(account for account in credentials if account != account_id)
+    # Events about specific VGWs only reconcile those VGWs, everything else is a full sweep
+    targets = getEventTargets(event or {})
+    if targets is None:
+        # Get list of regions so poller can look for VGWs in all regions
+        ec2 = getEc2Client(account_id, 'us-east-1')
+        regions = ec2.describe_regions()
+        targets = [(account, region['RegionName'], None) for account in accounts for region in regions['Regions']]
+        partial = False
+    else:
+        log.info('Reconciling VGWs from %s event: %s', event.get('detail-type'), targets)
+        for target in targets:
+            if target[0] not in accounts:
+                log.warning('Ignoring VGWs %s of account %s, which is not a spoke account this run can access',
+                            target[2], target[0])
+        targets = [target for target in targets if target[0] in accounts]
+        partial = True
+    # Scan the accounts and regions concurrently and merge what needs to be done into one plan
+    with metrics.timer('scan'):
+        plan = scanRegions(targets, credentials)
+    log.info('Found %s VGWs to process and %s spokes to check for new CIDR blocks',
+             sum(1 for item in plan if item['action'] != 'update'), sum(1 for item in plan if item['action'] == 'update'))
+
+    # Process every pending VGW this run has budget for
+    with metrics.timer('apply'):
+        applyPlan(plan, s3, context, partial)
@@ -0,0 +1,148 @@
+"""Codec for the VPN configs the poller writes to S3 and the TNSR agent reads back.
+
+A config is the CustomerGatewayConfiguration document EC2 generates for a VPN
+connection with a <transit_vpc_config> block added to its root element. The
+poller adds the block with injectTransitConfig, which splices it into the
+document text without building a DOM. The agent reads the fields it needs in
+one streaming pass with parseVpnConfig.
+"""
+
+import io
+import re
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+# Fields of the <transit_vpc_config> block, in the order the poller writes them
+TRANSIT_FIELDS = ('account_id', 'vpn_endpoint', 'spoke_subnet', 'customer_local_ip', 'status')
+
+# Where each VpnConfig field lives, as the element path below the <vpn_connection> root. Tunnel fields are
+# read from the first <ipsec_tunnel>.
+FIELD_PATHS = {
+  ('transit_vpc_config', 'status'): 'vpn_status',
+  ('transit_vpc_config', 'spoke_subnet'): 'spoke_subnet',
+  ('transit_vpc_config', 'customer_local_ip'): 'customer_local_ip',
+  ('ipsec_tunnel', 'customer_gateway', 'tunnel_outside_address', 'ip_address'): 'customer_gateway_ip',
+  ('ipsec_tunnel', 'customer_gateway', 'tunnel_inside_address', 'ip_address'): 'customer_inside_ip',
+  ('ipsec_tunnel', 'vpn_gateway', 'tunnel_outside_address', 'ip_address'): 'vpn_gateway_ip',
+  ('ipsec_tunnel', 'vpn_gateway', 'tunnel_inside_address', 'ip_address'): 'vpn_inside_ip',
+  ('ipsec_tunnel', 'ike', 'pre_shared_key'): 'ike_psk',
+}
+
+# Fields which may be given more than once or as a comma separated list, with the VpnConfig field which holds all
+# their values; the field itself holds the first one. A spoke VPC can have several CIDR blocks.
+LIST_FIELDS = {'spoke_subnet': 'spoke_subnets'}
+
+ROOT_TAG = 'vpn_connection'
+_start_tag = re.compile(r'<([A-Za-z_][\w.-]*)')
+
+
+class ConfigError(ValueError):
+  """A VPN config which cannot be read or is missing a field."""
+
+
+class VpnConfig(object):
+  """The tunnel parameters of one VPN config."""
+
+  __slots__ = tuple(FIELD_PATHS.values()) + tuple(LIST_FIELDS.values())
+
+  def __init__(self, **fields):
+    for name in self.__slots__:
+      setattr(self, name, fields[name])
+    for name in LIST_FIELDS.values():
+      setattr(self, name, tuple(getattr(self, name)))
+
+  def asDict(self):
+    fields = dict((name, getattr(self, name)) for name in self.__slots__)
+    for name in LIST_FIELDS.values():
+      fields[name] = list(fields[name])
+    return fields
+
+  @classmethod
+  def fromDict(cls, fields):
+    fields = dict(fields)
+    # Stored by versions which kept a single value
+    for name, list_name in LIST_FIELDS.items():
+      if list_name not in fields:
+        fields[list_name] = [fields[name]]
+    return cls(**fields)
+
+  def __eq__(self, other):
+    return isinstance(other, VpnConfig) and self.asDict() == other.asDict()
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return 'VpnConfig(vpn_gateway_ip={0!r}, spoke_subnet={1!r}, vpn_status={2!r})'.format(
+      self.vpn_gateway_ip, self.spoke_subnet, self.vpn_status)
+
+
+def injectTransitConfig(xml, fields):
+  """Return the document xml with a <transit_vpc_config> block holding the (name, value) pairs in fields
+  appended to its root element; a name may be given more than once. The rest of the document is passed through
+  untouched."""
+  block = ['<transit_vpc_config>']
+  for name, value in fields:
+    block.append('<{0}>{1}</{0}>'.format(name, escape(value)))
+  block.append('</transit_vpc_config>')
+
+  # The root element is the first element after the XML declaration, comments and processing instructions
+  position = 0
+  while True:
+    position = xml.find('<', position)
+    if position < 0:
+      raise ConfigError('document has no root element')
+    if xml.startswith('<?', position) or xml.startswith('<!', position):
+      position = xml.find('>', position) + 1
+      continue
+    break
+  root = _start_tag.match(xml, position)
+  if root is None:
+    raise ConfigError('document has no root element')
+
+  closing = '</' + root.group(1)
+  end = xml.rfind(closing)
+  if end < 0 or xml[end + len(closing):].strip() != '>':
+    raise ConfigError('document does not end with the {0} closing tag'.format(closing + '>'))
+  return xml[:end] + ''.join(block) + xml[end:]
+
+
+def parseVpnConfig(data):
+  """Read the tunnel parameters from a VPN config document (bytes or str) in one streaming pass."""
+  if isinstance(data, str):
+    data = data.encode('utf-8')
+  fields = {}
+  lists = dict((name, []) for name in LIST_FIELDS)
+  path = []
+  tunnels = 0
+  try:
+    for event, element in ET.iterparse(io.BytesIO(data), events=('start', 'end')):
+      if event == 'start':
+        if not path and element.tag != ROOT_TAG:
+          raise ConfigError('root element is <{0}>, expected <{1}>'.format(element.tag, ROOT_TAG))
+        if len(path) == 1 and element.tag == 'ipsec_tunnel':
+          tunnels += 1
+        path.append(element.tag)
+        continue
+      # Only the first ipsec_tunnel is configured
+      if path[1:2] != ['ipsec_tunnel'] or tunnels == 1:
+        name = FIELD_PATHS.get(tuple(path[1:]))
+        if name in lists:
+          lists[name].extend(value.strip() for value in (element.text or '').split(',') if value.strip())
+        elif name is not None and name not in fields:
+          fields[name] = (element.text or '').strip()
+      path.pop()
+      element.clear()
+  except ET.ParseError as e:
+    raise ConfigError('not a valid XML document: {0}'.format(e))
+  for name, values in lists.items():
+    fields[name] = values[0] if values else ''
+    fields[LIST_FIELDS[name]] = values
+
+  for field_path, name in FIELD_PATHS.items():
+    # A VGW detached from its VPC before it was untagged has no spoke subnet, and deleting its tunnel needs none
+    if name == 'spoke_subnet' and fields.get('vpn_status') == 'delete':
+      continue
+    if not fields.get(name):
+      raise ConfigError('VPN config has no {0}'.format('/'.join((ROOT_TAG,) + field_path)))
+  return VpnConfig(**fields)
@@ -1,10 +1,25 @@
 #!/usr/bin/env python
 
+import argparse
+import json
+import os
+import queue
+import random
+import signal
+import threading
+import time
+import traceback
 import urllib.parse
 import boto3
 import requests
 from botocore.client import Config
-from xml.dom import minidom
+from botocore.exceptions import ClientError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import transitvpc_codec
+import transitvpc_metrics
+import transitvpc_routes
+from transitvpc_codec import VpnConfig
 
 
 rest_url = 'https://localhost/restconf/data'
@@ -12,216 +27,829 @@ headers = {'Content-Type': 'application/yang-data+json'}
 cert_file = '/etc/pki/tls/tnsr/certs/restconf-client.crt'
 key_file = '/etc/pki/tls/tnsr/private/restconf-client.key'
 ca_cert_file = '/etc/pki/tls/tnsr/CA/restconf-CA.crt'
+bucket_name = 'netgate-transit-vpnconfigs'
+# The poller writes the configs of each TNSR endpoint under its own prefix (S3Prefix + endpoint name + '/'), this
+# instance only applies the configs under config_prefix. Set TRANSITVPC_PREFIX in /etc/sysconfig/transitvpc on
+# every endpoint but CSR1.
+config_prefix = os.environ.get('TRANSITVPC_PREFIX', 'vpnconfigs/CSR1/')
+# Index of the configs kept by the poller under the prefix. When it is there only the manifest is read each run
+# and only the configs it lists with a newer generation than the last one synced are downloaded; without it the
+# prefix is listed. A manifest the poller has built again gets a new epoch and starts its generations over.
+manifest_key = config_prefix + 'manifest.json'
+manifest_epoch = None
+manifest_generation = 0
+manifest_etag = None
+# Configs which could not be read, keyed by S3 key, with the generation and ETag they were listed with. A config
+# which does not parse is only fetched again once it changes, any other failure is retried on every run.
+failed_configs = {}
+# Tunnel parameters of every config seen in the bucket, keyed by S3 key
+sync_cache_file = '/var/lib/transitvpc/s3-cache.json'
+# RESTCONF (connect, read) timeouts in seconds, and retries of failed idempotent requests with exponential backoff
+restconf_timeout = (5, 30)
+restconf_retries = 3
+restconf_backoff = 0.5
+# How changes are sent to TNSR: 'yang-patch' sends the changes of up to apply_batch_size tunnels as one atomic
+# YANG-PATCH (RFC 8072) request, 'single' sends one request per change and undoes a tunnel's earlier changes
+# when a later one fails. 'yang-patch' falls back to 'single' if TNSR does not support YANG-PATCH.
+apply_mode = 'yang-patch'
+apply_batch_size = 50
+# Route changes which do not belong to a tunnel's changes are sent after them, up to route_batch_size per YANG-PATCH
+route_batch_size = 500
+# Number of configs downloaded from S3 at the same time
+fetch_workers = 16
+# In daemon mode the TNSR snapshot is reused while nothing changes, but read again at least this often (seconds)
+# so that changes made on TNSR by hand are still reconciled
+snapshot_max_age = 600
+# Prometheus textfile the metrics are written to after every run, for the node_exporter textfile collector (empty
+# turns it off). Set TRANSITVPC_METRICS_FILE in /etc/sysconfig/transitvpc to point it at the collector's directory.
+metrics_file = os.environ.get('TRANSITVPC_METRICS_FILE', '/var/lib/transitvpc/transitvpc.prom')
+metrics = transitvpc_metrics.Metrics()
+s3_client = None
 
-def getTunnelId(vpn_gateway_ip):
-  tunnels = requests.get(rest_url+'/netgate-tunnel:tunnels-config/netgate-ipip:ipip', cert=(cert_file, key_file), verify=ca_cert_file)
-  if tunnels.status_code != 404 and tunnels.json():
-    for tunnel in tunnels.json()['netgate-ipip:ipip']['tunnel']:
-      if tunnel['ipv4-remote-endpoint-address'] == vpn_gateway_ip:
-        return tunnel['instance']
-
-def getNextTunnelId():
-  tunnelId = 0
-  listOfTunnels = []
-  tunnels = requests.get(rest_url+'/netgate-ipsec:ipsec-config', cert=(cert_file, key_file), verify=ca_cert_file)
-  if tunnels.status_code != 404 and tunnels.json():
-    for tunnel in  tunnels.json()['netgate-ipsec:ipsec-config']['tunnel']:
-      listOfTunnels.append(tunnel['instance'])
-    while tunnelId in listOfTunnels:
-      tunnelId+=1
-    return tunnelId
-  return tunnelId
+class RestconfClient(object):
+  """RESTCONF client for TNSR which keeps one mutual-TLS session open and reuses its connections."""
 
-def createIPSec():
-  s3 = boto3.client('s3', endpoint_url='https://s3-eu-west-1.amazonaws.com', config=Config(s3={'addressing_style': 'virtual'}, signature_version='s3v4'))
+  def __init__(self, url=rest_url, cert=(cert_file, key_file), verify=ca_cert_file, timeout=restconf_timeout,
+               retries=restconf_retries, backoff=restconf_backoff, pool_size=4):
+    self.url = url
+    self.timeout = timeout
+    self.session = requests.Session()
+    self.session.cert = cert
+    self.session.verify = verify
+    self.session.headers.update(headers)
+    # Only idempotent methods (GET, PUT, DELETE) are retried, on connection errors and on the statuses TNSR
+    # returns while its backend restarts
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(502, 503, 504), raise_on_status=False)
+    self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry))
 
-  if 'Contents' in s3.list_objects(Bucket='netgate-transit-vpnconfigs'):
-    pass
-  else:
-    print("AWS S3 Bucket is Empty")
-    return
+  def request(self, method, path, **kwargs):
+    kwargs.setdefault('timeout', self.timeout)
+    # requests prefers REQUESTS_CA_BUNDLE from the environment over the session's CA unless it is passed here
+    kwargs.setdefault('verify', self.session.verify)
+    with metrics.timer('restconf_request', method=method):
+      try:
+        response = self.session.request(method, self.url + path, **kwargs)
+      except requests.RequestException:
+        metrics.count('restconf_errors', method=method)
+        raise
+    metrics.count('restconf_requests', method=method, status=str(response.status_code))
+    retries = getattr(response.raw, 'retries', None)
+    if retries is not None and retries.history:
+      metrics.count('restconf_retries', len(retries.history), method=method)
+    return response
+
+  def get(self, path, **kwargs):
+    return self.request('GET', path, **kwargs)
+
+  def put(self, path, data, **kwargs):
+    return self.request('PUT', path, json=data, **kwargs)
+
+  def delete(self, path, **kwargs):
+    return self.request('DELETE', path, **kwargs)
+
+  def yangPatch(self, patch_id, edits, **kwargs):
+    """Apply (operation, target, value) edits to the datastore as one YANG-PATCH, which TNSR applies atomically."""
+    patch = {"ietf-yang-patch:yang-patch": {"patch-id": patch_id, "edit": []}}
+    for n, (operation, target, value) in enumerate(edits):
+      edit = {"edit-id": str(n + 1), "operation": operation, "target": target}
+      if value is not None:
+        edit["value"] = value
+      patch["ietf-yang-patch:yang-patch"]["edit"].append(edit)
+    return self.request('PATCH', '', data=json.dumps(patch),
+                        headers={'Content-Type': 'application/yang-patch+json', 'Accept': 'application/yang-data+json'}, **kwargs)
+
+  def close(self):
+    self.session.close()
+
+restconf = RestconfClient()
+
+ipip_path = '/netgate-tunnel:tunnels-config/netgate-ipip:ipip'
+ipsec_path = '/netgate-ipsec:ipsec-config'
+interfaces_path = '/netgate-interface:interfaces-config'
+routes_path = '/netgate-route-table:route-table-config/static-routes/route-table=ipv4-VRF:0/ipv4-routes'
+
+def getList(client, path, container, key):
+  response = client.get(path)
+  if response.status_code == 404 or not response.content:
+    return []
+  response.raise_for_status()
+  return (response.json().get(container) or {}).get(key, [])
+
+class TnsrState(object):
+  """Snapshot of the tunnel configuration on TNSR, read once per run and indexed by instance and remote endpoint."""
+
+  def __init__(self, client):
+    self.ipip = dict((tunnel['instance'], tunnel) for tunnel in getList(client, ipip_path, 'netgate-ipip:ipip', 'tunnel'))
+    self.ipsec = dict((tunnel['instance'], tunnel) for tunnel in getList(client, ipsec_path, 'netgate-ipsec:ipsec-config', 'tunnel'))
+    self.interfaces = dict((interface['name'], interface) for interface in getList(client, interfaces_path, 'netgate-interface:interfaces-config', 'interface'))
+    self.routes = dict((route['destination-prefix'], route) for route in getList(client, routes_path, 'netgate-route-table:ipv4-routes', 'route'))
+    self.by_endpoint = dict((tunnel['ipv4-remote-endpoint-address'], instance) for instance, tunnel in self.ipip.items())
+    self.used = set(self.ipip) | set(self.ipsec)
+    self.next_free = 0
+    self.taken = time.time()
+
+  def allocateId(self):
+    # Hand out the lowest instance which is neither an ipip nor an ipsec tunnel yet
+    while self.next_free in self.used:
+      self.next_free += 1
+    self.used.add(self.next_free)
+    return self.next_free
+
+  # The PUT body which restores an item as it is in the snapshot, or None if it is not there
+  def ipipBody(self, tunnel_id):
+    return {"netgate-ipip:tunnel": self.ipip[tunnel_id]} if tunnel_id in self.ipip else None
+
+  def ipsecBody(self, tunnel_id):
+    return {"netgate-ipsec:tunnel": self.ipsec[tunnel_id]} if tunnel_id in self.ipsec else None
+
+  def interfaceBody(self, if_name):
+    return {"netgate-interface:interface": [self.interfaces[if_name]]} if if_name in self.interfaces else None
+
+  def routeBody(self, prefix):
+    return {"netgate-route-table:route": [self.routes[prefix]]} if prefix in self.routes else None
+
+  def routesVia(self, if_name):
+    return sorted(prefix for prefix, route in self.routes.items() if any(hop[0] == if_name for hop in routeHops(route)))
+
+# The (interface, address) of each next hop of a route
+def routeHops(route):
+  return [(hop.get('if-name'), hop.get('ipv4-address')) for hop in route.get('next-hop', {}).get('hop', [])]
 
-  for file in s3.list_objects(Bucket='netgate-transit-vpnconfigs')['Contents']:
-    config = s3.get_object(Bucket='netgate-transit-vpnconfigs', Key=file['Key'])
-    xmldoc = minidom.parseString(config['Body'].read())
-    vpn_config = xmldoc.getElementsByTagName("transit_vpc_config")[0]
-    vpn_status = vpn_config.getElementsByTagName("status")[0].firstChild.data
-    spoke_subnet = vpn_config.getElementsByTagName('spoke_subnet')[0].firstChild.data
-    vpn_connection = xmldoc.getElementsByTagName('vpn_connection')[0]
-    ipsec_tunnel = vpn_connection.getElementsByTagName("ipsec_tunnel")[0]
-    customer_gateway = ipsec_tunnel.getElementsByTagName("customer_gateway")[0]
-    customer_gateway_ip = customer_gateway.getElementsByTagName("tunnel_outside_address")[0].getElementsByTagName("ip_address")[0].firstChild.data
-    customer_inside_ip = customer_gateway.getElementsByTagName("tunnel_inside_address")[0].getElementsByTagName("ip_address")[0].firstChild.data
-    customer_local_ip = vpn_config.getElementsByTagName("customer_local_ip")[0].firstChild.data
-    vpn_gateway = ipsec_tunnel.getElementsByTagName("vpn_gateway")[0]
-    vpn_gateway_ip = vpn_gateway.getElementsByTagName("tunnel_outside_address")[0].getElementsByTagName("ip_address")[0].firstChild.data
-    vpn_inside_ip = vpn_gateway.getElementsByTagName("tunnel_inside_address")[0].getElementsByTagName("ip_address")[0].firstChild.data
-    ike_config = ipsec_tunnel.getElementsByTagName("ike")[0]
-    ike_psk = ike_config.getElementsByTagName("pre_shared_key")[0].firstChild.data
-
-    if vpn_status == 'delete':
-      tunnel_id = getTunnelId(vpn_gateway_ip)
-      print(tunnel_id)
-      print(type(tunnel_id))
-
-      print("Delete IPSec{0} interface from TNSR".format(tunnel_id, vpn_gateway_ip))
-      requests.delete(rest_url + '/interfaces-config/interface=ipsec{0}'.format(tunnel_id), params={})
-      print("Delete IPSec tunnel{0} with VGW:{1} from TNSR".format(tunnel_id, vpn_gateway_ip))
-      ipsecdel = requests.delete(rest_url + '/ipsec-config/tunnel={0}'.format(tunnel_id), params={})
-      print("Delete routes to spoke subnet:{0}".format(spoke_subnet))
-      requests.delete(rest_url + '/route-table-config/static-routes/route-table=ipv4-VRF:0/ipv4-routes/route='+urllib.parse.quote_plus(spoke_subnet))
-      if ipsecdel.status_code == 200:
-        print("Delete IPSec config with VGW:{0} from S3".format(vpn_gateway_ip))
-        s3.delete_object(Bucket='netgate-transit-vpnconfigs', Key=file['Key'])
-        print("IPSec tunnel{0} has deleted".format(tunnel_id))
-
-    elif vpn_status == 'create':
-      tunnel_id = getNextTunnelId()
-      if not isinstance(getTunnelId(vpn_gateway_ip), int):
-
-        ipsec_config = {
-          "netgate-ipsec:tunnel": {
-            "instance": 0,
-            "tunnel-enable": True,
-            "crypto": {
-              "config-type":"ike",
-              "ike": {
-                "key-renewal": "reauth",
-                "role": "initiator-only",
-                "version":1,
-                "lifetime":14400,
-                "proposals":[
-                  {
-                    "name":"1",
-                    "encryption-algorithm":"aes128",
-                    "integrity-algorithm":"sha1",
-                    "dh-group":"modp1024"
-                  }
-                ],
-                "identity":[
-                  {
-                    "peer":"local",
-                    "type":"address",
-                    "value":"%VARIABLE%"
-                  },
-                  {
-                    "peer":"remote",
-                    "type":"address",
-                    "value":"%VARIABLE%"
-                  }
-                ],
-                "authentication":[
-                  {
-                    "peer":"local",
-                    "round":[
-                      {
-                        "number":1,
-                        "psk":"%VARIABLE%"
-                      }
-                    ]
-                  },
-                  {
-                    "peer":"remote",
-                    "round":[
-                      {
-                        "number":1,
-                        "psk":"%VARIABLE%"
-                      }
-                    ]
-                  }
-                ],
-                "child-sa":[
-                  {
-                    "name":"1",
-                    "lifetime":3600,
-                    "proposal":[
-                      {
-                        "name":"1",
-                        "encryption-algorithm":"aes128",
-                        "integrity-algorithm":"sha1",
-                        "dh-group":"modp1024"
-                      }
-                    ]
-                  }
-                ]
-              }
+# A route is managed by the agent when all its next hops are interfaces of tunnels it has configs for (if_names)
+def managedRoute(route, if_names):
+  hops = routeHops(route)
+  return bool(hops) and all(if_name in if_names for if_name, _ in hops)
+
+# This function returns the VPN config objects under config_prefix with one paginated listing
+def listConfigs(s3):
+  paginator = s3.get_paginator('list_objects_v2')
+  pages = iter(paginator.paginate(Bucket=bucket_name, Prefix=config_prefix))
+  while True:
+    with metrics.timer('s3_list'):
+      page = next(pages, None)
+    if page is None:
+      return
+    for file in page.get('Contents', []):
+      # Only VPN configs are applied, the prefix also holds the poller's manifest
+      if file['Key'].endswith('.conf'):
+        yield file
+
+class ManifestMissing(Exception):
+  pass
+
+# This function returns the poller's manifest and its ETag, or (None, manifest_etag) if it has not changed since
+# the last run which synced it
+def loadManifest(s3):
+  kwargs = {'IfNoneMatch': manifest_etag} if manifest_etag else {}
+  try:
+    with metrics.timer('s3_get'):
+      obj = s3.get_object(Bucket=bucket_name, Key=manifest_key, **kwargs)
+  except ClientError as e:
+    code = e.response.get('Error', {}).get('Code')
+    if code in ('304', 'NotModified'):
+      return None, manifest_etag
+    if code in ('404', 'NoSuchKey'):
+      raise ManifestMissing(manifest_key)
+    raise
+  try:
+    return json.loads(obj['Body'].read()), obj['ETag']
+  except ValueError as e:
+    raise ManifestMissing('{0} is not valid JSON: {1}'.format(manifest_key, e))
+
+# The configs in the manifest, shaped like the objects of a bucket listing
+def manifestConfigs(manifest):
+  for key, config in sorted(manifest['configs'].items()):
+    yield {'Key': key, 'ETag': config['etag'], 'Generation': config['generation'], 'Status': config['status']}
+
+# A config which failed to read, shaped like the objects of the manifest
+def retryConfig(key, failure):
+  return {'Key': key, 'ETag': failure['etag'], 'Generation': failure['generation'], 'Status': None}
+
+# The cache entry of a config which has disappeared: its tunnel is deleted like one marked for deletion
+def removedEntry(entry):
+  params = entry['params'].asDict()
+  params['vpn_status'] = 'delete'
+  return dict(entry, params=VpnConfig.fromDict(params))
+
+def loadSyncCache():
+  global manifest_epoch, manifest_generation, failed_configs
+  try:
+    with open(sync_cache_file) as f:
+      cache = json.load(f)
+  except (IOError, ValueError):
+    return {}
+  # Older versions stored the entries only
+  if 'configs' in cache:
+    manifest_epoch = cache.get('manifest_epoch')
+    manifest_generation = cache.get('manifest_generation', 0)
+    failed_configs = cache.get('failed', {})
+    cache = cache['configs']
+  entries = {}
+  for key, entry in cache.items():
+    # Entries which cannot be read back (e.g. written by an older version) are dropped, the config is fetched again
+    try:
+      entry['params'] = VpnConfig.fromDict(entry['params'])
+    except (KeyError, TypeError):
+      continue
+    entries[key] = entry
+  return entries
+
+# The cache holds the pre-shared keys, so it is only readable by root. epoch and generation are the manifest epoch
+# and generation the entries are synced to, failed the configs which could not be read.
+def saveSyncCache(cache, epoch, generation, failed):
+  cache_dir = os.path.dirname(sync_cache_file)
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir, 0o700)
+  tmp_file = sync_cache_file + '.tmp'
+  with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+    json.dump({'manifest_epoch': epoch, 'manifest_generation': generation, 'failed': failed,
+               'configs': dict((key, dict(entry, params=entry['params'].asDict())) for key, entry in cache.items())}, f)
+  os.rename(tmp_file, sync_cache_file)
+
+# This function returns the cache entry of every VPN config, downloading and parsing only the objects which are
+# new or changed since they were cached. With the poller's manifest, configs whose generation is past the last one
+# synced are fetched and a cached config which is no longer in the manifest is deleted. Without a manifest the
+# prefix is listed and configs are compared by ETag and LastModified.
+# Returns the entries with the manifest epoch, generation and ETag they are synced to and the configs which could not
+# be read. The caller only makes those the manifest_epoch, manifest_generation, manifest_etag and failed_configs of
+# the next sync once the entries are saved, so that a run which fails after the sync reads the same configs again. A
+# config which could not be read does not hold the others back: only the failed configs are fetched again, even when
+# the manifest has not changed.
+# It runs as a pipeline: the manifest or the paginated listing feeds a bounded queue of keys to fetch_workers
+# download threads, which feed a bounded queue of bodies to the parser (this thread), so each stage blocks when the
+# next one falls behind.
+def syncConfigs(s3, cache):
+  synced = manifest_generation
+  try:
+    manifest, etag = loadManifest(s3)
+  except ManifestMissing as e:
+    print("No manifest ({0}), listing {1}".format(e, config_prefix))
+    manifest, etag = {}, None
+  if manifest is None:
+    # Nothing was written since the last run, only the configs which failed for another reason than their content
+    # are read again
+    if all(failure['invalid'] for failure in failed_configs.values()):
+      return dict(cache), manifest_epoch, manifest_generation, manifest_etag, dict(failed_configs)
+  # The manifest has been rebuilt, everything in it is read again. Manifests written before epochs were added can
+  # only tell by their generation.
+  if manifest and (manifest.get('epoch') != manifest_epoch or manifest['generation'] < synced):
+    synced = 0
+  fetch_queue = queue.Queue(fetch_workers * 4)
+  body_queue = queue.Queue(fetch_workers * 4)
+  list_errors = []
+
+  def lister():
+    try:
+      if manifest is None:
+        files = [retryConfig(key, failure) for key, failure in sorted(failed_configs.items())]
+      elif manifest:
+        files = manifestConfigs(manifest)
+      else:
+        files = listConfigs(s3)
+      for file in files:
+        entry = cache.get(file['Key'])
+        failure = failed_configs.get(file['Key'])
+        if failure is not None:
+          # A config which did not parse is fetched again once it has changed, anything else on every run
+          fresh = not failure['invalid'] or (failure['generation'], failure['etag']) != (file.get('Generation'), file['ETag'])
+        elif 'Generation' in file:
+          # Configs marked for deletion which are not cached have been removed from TNSR already
+          fresh = file['Generation'] > synced or (entry is None and file['Status'] != 'delete')
+        else:
+          fresh = entry is None or entry['etag'] != file['ETag'] or entry['last_modified'] != file['LastModified'].isoformat()
+        if fresh:
+          fetch_queue.put(file)
+        elif entry is not None or failure is not None:
+          body_queue.put((file, entry, None, None))
+    except Exception as e:
+      list_errors.append(e)
+    finally:
+      for _ in range(fetch_workers):
+        fetch_queue.put(None)
+
+  def fetcher():
+    while True:
+      file = fetch_queue.get()
+      if file is None:
+        body_queue.put(None)
+        return
+      try:
+        with metrics.timer('s3_get'):
+          obj = s3.get_object(Bucket=bucket_name, Key=file['Key'])
+        body_queue.put((file, None, obj, None))
+      except Exception as e:
+        body_queue.put((file, None, None, e))
+
+  threads = [threading.Thread(target=lister)] + [threading.Thread(target=fetcher) for _ in range(fetch_workers)]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+
+  # Configs which are not read again keep their cache entry
+  entries = dict(cache) if manifest is None else {}
+  failed = {}
+  running = fetch_workers
+  while running:
+    item = body_queue.get()
+    if item is None:
+      running -= 1
+      continue
+    file, entry, obj, error = item
+    key = file['Key']
+    # Unchanged configs come straight from the cache, and one which did not parse stays failed until it changes
+    if obj is None and error is None:
+      if entry is not None:
+        entries[key] = entry
+      if key in failed_configs:
+        failed[key] = failed_configs[key]
+      continue
+    try:
+      if error is not None:
+        raise error
+      body = obj['Body'].read()
+      with metrics.timer('xml_parse'):
+        params = transitvpc_codec.parseVpnConfig(body)
+      entries[key] = {'etag': obj['ETag'], 'last_modified': obj['LastModified'].isoformat(), 'params': params}
+    except Exception as e:
+      # The agent removes a config once its tunnel is deleted, the manifest keeps listing it for a while
+      if (manifest is None or manifest) and isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+        if key in cache:
+          entries[key] = removedEntry(cache[key])
+        continue
+      # Keep what was known about the config
+      print("Failed to read config {0}: {1}".format(key, e))
+      failed[key] = {'generation': file.get('Generation'), 'etag': file['ETag'],
+                     'invalid': isinstance(e, transitvpc_codec.ConfigError)}
+      if key in cache:
+        entries[key] = cache[key]
+  if list_errors:
+    raise list_errors[0]
+  if manifest is None:
+    return entries, manifest_epoch, manifest_generation, manifest_etag, failed
+  if manifest:
+    for key, entry in cache.items():
+      if key not in entries:
+        entries[key] = removedEntry(entry)
+    return entries, manifest.get('epoch'), manifest['generation'], etag, failed
+  return entries, manifest_epoch, manifest_generation, manifest_etag, failed
+
+def ipipPath(tunnel_id):
+  return ipip_path + '/tunnel={0}'.format(tunnel_id)
+
+def ipsecPath(tunnel_id):
+  return ipsec_path + '/tunnel={0}'.format(tunnel_id)
+
+def interfacePath(tunnel_id):
+  return interfaces_path + '/interface=ipsec{0}'.format(tunnel_id)
+
+def routePath(prefix):
+  return routes_path + '/route=' + urllib.parse.quote_plus(prefix)
+
+def ipipConfig(tunnel_id, params):
+  return {
+    "netgate-ipip:tunnel": {
+      "instance": tunnel_id, # Tunnel's ID
+      "ipv4-local-endpoint-address": params.customer_local_ip, # Local PRIP
+      "ipv4-remote-endpoint-address": params.vpn_gateway_ip # Remote EXTIP
+    }
+  }
+
+def ipsecConfig(tunnel_id, params):
+  return {
+    "netgate-ipsec:tunnel": {
+      "instance": tunnel_id,
+      "tunnel-enable": True,
+      "crypto": {
+        "config-type":"ike",
+        "ike": {
+          "key-renewal": "reauth",
+          "role": "initiator-only",
+          "version":1,
+          "lifetime":14400,
+          "proposals":[
+            {
+              "name":"1",
+              "encryption-algorithm":"aes128",
+              "integrity-algorithm":"sha1",
+              "dh-group":"modp1024"
             }
-          }
-        }
-        interface_ipsec = {
-          "netgate-interface:interface":[
+          ],
+          "identity":[
+            {
+              "peer":"local",
+              "type":"address",
+              "value":params.customer_gateway_ip # Local EXTIP
+            },
             {
-              "name": "%VARIABLE%",
-              "enabled":bool('true'),
-              "ipv4":{
-                "address":{
-                  "ip":[
-                    "%VARIABLE%"
-                  ]
+              "peer":"remote",
+              "type":"address",
+              "value":params.vpn_gateway_ip # Remote EXTIP
+            }
+          ],
+          "authentication":[
+            {
+              "peer":"local",
+              "round":[
+                {
+                  "number":1,
+                  "psk":params.ike_psk # Local PSK KEY
                 }
-              }
+              ]
+            },
+            {
+              "peer":"remote",
+              "round":[
+                {
+                  "number":1,
+                  "psk":params.ike_psk # Remote PSK KEY
+                }
+              ]
+            }
+          ],
+          "child-sa":[
+            {
+              "name":"1",
+              "lifetime":3600,
+              "proposal":[
+                {
+                  "name":"1",
+                  "encryption-algorithm":"aes128",
+                  "integrity-algorithm":"sha1",
+                  "dh-group":"modp1024"
+                }
+              ]
             }
           ]
         }
-        route_table_config = {
-          "netgate-route-table:route":[
+      }
+    }
+  }
+
+def interfaceConfig(tunnel_id, params):
+  return {
+    "netgate-interface:interface":[
+      {
+        "name": "ipsec{0}".format(tunnel_id),
+        "enabled":True,
+        "ipv4":{
+          "address":{
+            "ip":[
+              "{0}/30".format(params.customer_inside_ip)
+            ]
+          }
+        }
+      }
+    ]
+  }
+
+def routeConfig(prefix, tunnel_id, vpn_inside_ip):
+  return {
+    "netgate-route-table:route":[
+      {
+        "destination-prefix":prefix,
+        "next-hop":{
+          "hop":[
             {
-              "destination-prefix":"%VARIABLE%",
-              "next-hop":{
-                "hop":[
-                  {
-                    "hop-id":1,
-                    "ipv4-address":"%VARIABLE%",
-                    "if-name":"%VARIABLE%"
-                  }
-                ]
-              }
+              "hop-id":1,
+              "ipv4-address":vpn_inside_ip,
+              "if-name":"ipsec{0}".format(tunnel_id)
             }
           ]
         }
-        ipip_config = {
-                "netgate-ipip:tunnel": {
-                      "instance": 0,
-                      "ipv4-local-endpoint-address": "%VARIABLE%",
-                      "ipv4-remote-endpoint-address": "%VARIABLE%"
-                    }
-        }
+      }
+    ]
+  }
+
+# A change is (method, path, data, undo) where undo is the change which reverts it
+def putChange(path, data, original):
+  return ('PUT', path, data, ('PUT', path, original, None) if original is not None else ('DELETE', path, None, None))
+
+def deleteChange(path, original):
+  return ('DELETE', path, None, ('PUT', path, original, None))
+
+# This function diffs the desired tunnels from the S3 configs against the TNSR snapshot and returns the minimal
+# list of changes: one action per config which needs work, each with the RESTCONF requests to send in order.
+# Routes are left to planRoutes, except that a tunnel takes the routes via it along when it is deleted.
+def planChanges(cache, state):
+  plan = []
+  # Deletes go first so a spoke which is re-created under the same VGW IP starts from a clean slate
+  for key, entry in sorted(cache.items(), key=lambda item: (item[1]['params'].vpn_status != 'delete', item[0])):
+    params = entry['params']
+    vpn_gateway_ip = params.vpn_gateway_ip
+    tunnel_id = state.by_endpoint.get(vpn_gateway_ip)
+    if_name = 'ipsec{0}'.format(tunnel_id)
+    changes = []
+
+    if params.vpn_status == 'delete':
+      if tunnel_id is not None:
+        for prefix in state.routesVia(if_name):
+          changes.append(deleteChange(routePath(prefix), state.routeBody(prefix)))
+        if if_name in state.interfaces:
+          changes.append(deleteChange(interfacePath(tunnel_id), state.interfaceBody(if_name)))
+        if tunnel_id in state.ipsec:
+          changes.append(deleteChange(ipsecPath(tunnel_id), state.ipsecBody(tunnel_id)))
+        changes.append(deleteChange(ipipPath(tunnel_id), state.ipipBody(tunnel_id)))
+        del state.by_endpoint[vpn_gateway_ip]
+      plan.append({'key': key, 'status': 'delete', 'tunnel_id': tunnel_id, 'params': params, 'changes': changes})
+
+    elif params.vpn_status == 'create':
+      new = tunnel_id is None
+      if new:
+        tunnel_id = state.allocateId()
+        if_name = 'ipsec{0}'.format(tunnel_id)
+        state.by_endpoint[vpn_gateway_ip] = tunnel_id
+        changes.append(putChange(ipipPath(tunnel_id), ipipConfig(tunnel_id, params), None))
+      # Put back whatever part of an existing tunnel is missing
+      if tunnel_id not in state.ipsec:
+        changes.append(putChange(ipsecPath(tunnel_id), ipsecConfig(tunnel_id, params), None))
+      if if_name not in state.interfaces:
+        changes.append(putChange(interfacePath(tunnel_id), interfaceConfig(tunnel_id, params), None))
+      if changes:
+        plan.append({'key': key, 'status': 'create', 'tunnel_id': tunnel_id, 'params': params, 'changes': changes,
+                     'new': new})
+  return plan
+
+# This function builds the route table the spokes need after the planned tunnel changes, with every subnet of a spoke
+# routed via its tunnel and adjacent subnets via the same tunnel aggregated, and adds the changes which bring the
+# routes via the tunnels of the configs in line with it to the plan. Routes via any other interface, including
+# ipsec interfaces of tunnels without a config (set up by hand, or whose config could not be read), are left alone.
+# A route via a tunnel which is created or repaired goes with the tunnel's changes, so a tunnel is never left
+# without its routes; the other changes become one 'route' action each, routes to add or replace ahead of routes to
+# remove. Returns the number of routes wanted.
+def planRoutes(cache, state, plan):
+  if_names = set('ipsec{0}'.format(state.by_endpoint[entry['params'].vpn_gateway_ip]) for entry in cache.values()
+                 if entry['params'].vpn_status == 'create')
+  if_names.update('ipsec{0}'.format(action['tunnel_id']) for action in plan
+                  if action['status'] == 'delete' and action['tunnel_id'] is not None)
+  table = transitvpc_routes.RouteTable()
+  for prefix, route in state.routes.items():
+    if not managedRoute(route, if_names):
+      table.block(prefix)
+  for key, entry in sorted(cache.items()):
+    params = entry['params']
+    if params.vpn_status != 'create':
+      continue
+    hop = (state.by_endpoint[params.vpn_gateway_ip], params.vpn_inside_ip)
+    for prefix in params.spoke_subnets:
+      try:
+        taken = table.add(prefix, hop)
+      except ValueError as e:
+        print("Not routing {0} of VGW:{1}: {2}".format(prefix, params.vpn_gateway_ip, e))
+        continue
+      if taken is None:
+        print("Not routing {0} of VGW:{1}: TNSR routes it outside the tunnels of the configs".format(prefix, params.vpn_gateway_ip))
+      elif taken != hop:
+        print("Not routing {0} of VGW:{1}: it is routed via tunnel{2} already".format(prefix, params.vpn_gateway_ip, taken[0]))
+  wanted = table.aggregate()
 
-        ipip = ipip_config['netgate-ipip:tunnel']
-        ipip['instance'] = tunnel_id # Tunnel's ID
-        ipip['ipv4-local-endpoint-address'] = customer_local_ip # Local PRIP
-        ipip['ipv4-remote-endpoint-address'] = vpn_gateway_ip # Remote EXTIP
-        tunnel = ipsec_config['netgate-ipsec:tunnel']
-        tunnel['instance'] = tunnel_id # Tunnel's ID
-        tunnel['crypto']['ike']['authentication'][0]['round'][0]['psk'] = ike_psk # Local PSK KEY
-        tunnel['crypto']['ike']['authentication'][1]['round'][0]['psk'] = ike_psk # Remote PSK KEY
-        tunnel['crypto']['ike']['identity'][0]['value'] = customer_gateway_ip # Local EXTIP
-        tunnel['crypto']['ike']['identity'][1]['value'] = vpn_gateway_ip # Remote EXTIP
-
-        interface_ipsec['netgate-interface:interface'][0]['name'] = "ipsec{0}".format(tunnel_id)
-        interface_ipsec['netgate-interface:interface'][0]['ipv4']['address']['ip'][0] = "{0}/30".format(customer_inside_ip)
-
-        route_table_config['netgate-route-table:route'][0]['destination-prefix'] = spoke_subnet
-        route_table_config['netgate-route-table:route'][0]['next-hop']['hop'][0]['ipv4-address'] = vpn_inside_ip
-        route_table_config['netgate-route-table:route'][0]['next-hop']['hop'][0]['if-name'] = "ipsec{0}".format(tunnel_id)
-
-        print("Configuring ipip{0} tunnel".format(tunnel_id))
-        out=requests.put(rest_url+'/netgate-tunnel:tunnels-config/netgate-ipip:ipip/tunnel={0}'.format(tunnel_id), params={}, json=ipip_config, headers=headers, cert=(cert_file, key_file), verify=ca_cert_file)
-        print(out.text)
-        print("Creating IPSec tunnel{0} with vgw-{1}".format(tunnel_id, vpn_gateway_ip))
-        out=requests.put(rest_url+'/netgate-ipsec:ipsec-config/tunnel={0}'.format(tunnel_id), params={}, json=ipsec_config, headers=headers, cert=(cert_file, key_file), verify=ca_cert_file)
-        print(out.text)
-        print("Configuring ipsec{0} interface".format(tunnel_id))
-        out=requests.put(rest_url+'/netgate-interface:interfaces-config/interface=ipsec{0}'.format(tunnel_id), params={}, json=interface_ipsec, headers=headers, cert=(cert_file, key_file), verify=ca_cert_file)
-        print(out.text)
-        print("Configuring ipsec{0} routes".format(tunnel_id)) 
-        out=requests.put(rest_url+'/netgate-route-table:route-table-config/static-routes/route-table=ipv4-VRF:0/ipv4-routes/route='+urllib.parse.quote_plus(spoke_subnet), params={}, json=route_table_config, headers=headers, cert=(cert_file, key_file), verify=ca_cert_file)
-        print(out.text)
-        print("IPSec tunnel{0} with vpn-getaway:{1} and subnet-{2} has created".format(tunnel_id, vpn_gateway_ip, spoke_subnet))
+  creates = dict((action['tunnel_id'], action) for action in plan if action['status'] == 'create')
+  # Routes via deleted tunnels are removed with them
+  removed = set(change[1] for action in plan if action['status'] == 'delete' for change in action['changes'])
+  added = []
+  for prefix, (tunnel_id, vpn_inside_ip) in sorted(wanted.items()):
+    path = routePath(prefix)
+    route = state.routes.get(prefix)
+    if route is not None and path not in removed and routeHops(route) == [('ipsec{0}'.format(tunnel_id), vpn_inside_ip)]:
+      continue
+    original = state.routeBody(prefix) if path not in removed else None
+    change = putChange(path, routeConfig(prefix, tunnel_id, vpn_inside_ip), original)
+    if tunnel_id in creates:
+      creates[tunnel_id]['changes'].append(change)
+    else:
+      added.append({'key': None, 'status': 'route', 'tunnel_id': tunnel_id, 'prefix': prefix, 'params': None,
+                    'changes': [change]})
+  stale = []
+  for prefix, route in sorted(state.routes.items()):
+    if prefix not in wanted and managedRoute(route, if_names) and routePath(prefix) not in removed:
+      stale.append({'key': None, 'status': 'route', 'tunnel_id': None, 'prefix': prefix, 'params': None,
+                    'changes': [deleteChange(routePath(prefix), state.routeBody(prefix))]})
+  plan.extend(added + stale)
+  return len(wanted)
 
+class YangPatchUnsupported(Exception):
+  pass
+
+def sendChange(method, path, data):
+  if method == 'PUT':
+    out = restconf.put(path, data)
+  else:
+    out = restconf.delete(path)
+  # Deleting something which is already gone is fine
+  if out.status_code >= 400 and not (method == 'DELETE' and out.status_code == 404):
+    print("{0} {1} failed with {2}: {3}".format(method, path, out.status_code, out.text))
+    return False
+  return True
+
+# This function sends the changes of one action one request at a time. If one of them fails the changes already
+# sent are undone in reverse order, so no half-built tunnel is left behind.
+def applyAction(action):
+  sent = []
+  for method, path, data, undo in action['changes']:
+    if not sendChange(method, path, data):
+      for undo_method, undo_path, undo_data, _ in reversed(sent):
+        sendChange(undo_method, undo_path, undo_data)
+      return False
+    sent.append(undo)
+  return True
+
+# This function sends the changes of a batch of actions as one atomic YANG-PATCH. When TNSR rejects the patch the
+# batch is split in halves and retried, so one bad tunnel does not hold back the others. It returns the actions
+# which were applied.
+def patchActions(actions):
+  edits = []
+  for action in actions:
+    for method, path, data, undo in action['changes']:
+      edits.append(('replace', path, data) if method == 'PUT' else ('remove', path, None))
+  if not edits:
+    return list(actions)
+  out = restconf.yangPatch('transitvpc-{0}'.format(int(time.time() * 1000)), edits)
+  if out.status_code < 300:
+    return list(actions)
+  if out.status_code in (405, 415, 501):
+    raise YangPatchUnsupported(out.status_code)
+  if len(actions) == 1:
+    action = actions[0]
+    target = 'route {0}'.format(action['prefix']) if action['status'] == 'route' else 'tunnel{0}'.format(action['tunnel_id'])
+    print("YANG-PATCH for {0} failed with {1}: {2}".format(target, out.status_code, out.text))
+    return []
+  half = len(actions) // 2
+  return patchActions(actions[:half]) + patchActions(actions[half:])
+
+# This function sends the actions to TNSR in order, batch_size actions at a time, according to apply_mode. Returns
+# the actions which were applied.
+def applyBatches(actions, batch_size):
+  global apply_mode
+  applied = []
+  pending = list(actions)
+  while pending and apply_mode == 'yang-patch':
+    batch = pending[:batch_size]
+    try:
+      applied += patchActions(batch)
+    except YangPatchUnsupported as e:
+      print("TNSR does not support YANG-PATCH ({0}), sending changes one at a time".format(e))
+      apply_mode = 'single'
+      break
+    pending = pending[batch_size:]
+  if apply_mode != 'yang-patch':
+    for action in pending:
+      if applyAction(action):
+        applied.append(action)
+      elif action['status'] != 'route':
+        print("IPSec tunnel{0} with VGW:{1} was rolled back, retrying on the next run".format(action['tunnel_id'], action['params'].vpn_gateway_ip))
+  return applied
+
+# This function sends the changes of every planned action to TNSR: the tunnel actions apply_batch_size at a time,
+# then the route actions route_batch_size at a time. Routes are only removed once every route which was to be added
+# is in place, as one of those may be the aggregate which takes over their traffic. A delete action also removes the
+# config from S3 (and the cache) once TNSR has accepted all its changes. Returns the actions which were applied.
+def applyChanges(plan, s3, cache):
+  tunnels = [action for action in plan if action['status'] != 'route']
+  added = [action for action in plan if action['status'] == 'route' and action['changes'][0][0] == 'PUT']
+  stale = [action for action in plan if action['status'] == 'route' and action['changes'][0][0] == 'DELETE']
+  applied = applyBatches(tunnels, apply_batch_size)
+  applied += applyBatches(added, route_batch_size)
+  done = set(id(action) for action in applied)
+  unrouted = [action for action in tunnels + added if id(action) not in done and
+              any(method == 'PUT' and path.startswith(routes_path) for method, path, data, undo in action['changes'])]
+  if not unrouted:
+    applied += applyBatches(stale, route_batch_size)
+  elif stale:
+    print("Keeping {0} routes which are no longer needed until the routes replacing them are added".format(len(stale)))
+
+  for action in applied:
+    tunnel_id = action['tunnel_id']
+    if action['status'] == 'route':
+      if action['changes'][0][0] == 'DELETE':
+        print("Route to {0} has been removed".format(action['prefix']))
       else:
-        print("Tunnel with vgw {0} already exists, skipping configuration.".format(vpn_gateway_ip))
-        pass
+        print("Route to {0} via ipsec{1} has been set".format(action['prefix'], tunnel_id))
+      continue
+    vpn_gateway_ip = action['params'].vpn_gateway_ip
+    spoke_subnet = ','.join(action['params'].spoke_subnets)
+    if action['status'] == 'delete':
+      print("Delete IPSec config with VGW:{0} from S3".format(vpn_gateway_ip))
+      s3.delete_object(Bucket=bucket_name, Key=action['key'])
+      del cache[action['key']]
+      print("IPSec tunnel{0} has deleted".format(tunnel_id))
+    else:
+      print("IPSec tunnel{0} with vpn-getaway:{1} and subnet-{2} has created".format(tunnel_id, vpn_gateway_ip, spoke_subnet))
+  return applied
+
+def getS3():
+  global s3_client
+  if s3_client is None:
+    s3_client = boto3.client('s3', endpoint_url='https://s3-eu-west-1.amazonaws.com', config=Config(s3={'addressing_style': 'virtual'}, signature_version='s3v4', max_pool_connections=fetch_workers))
+    metrics.instrumentClient(s3_client)
+  return s3_client
+
+# This function syncs the configs from S3 and reconciles TNSR with them. The TNSR snapshot of the previous run
+# is reused when nothing changed in S3 and that run had nothing to apply. Returns the new cache, the snapshot
+# to reuse next time (None when it has to be read again) and whether anything changed. The synced manifest
+# epoch, generation and ETag only move on once the new cache is saved: if the run fails before that, the caller keeps the
+# old cache and the next run syncs the same changes again.
+def reconcile(s3, cache, state=None):
+  global manifest_epoch, manifest_generation, manifest_etag, failed_configs
+  with metrics.timer('sync'):
+    entries, epoch, generation, etag, failed = syncConfigs(s3, cache)
+  metrics.gauge('configs', len(entries))
+  metrics.gauge('failed_configs', len(failed))
+  # A config which is read again with the same content has not changed
+  changed = (set(entries) != set(cache) or any(entry != cache[key] for key, entry in entries.items())
+             or (epoch, generation) != (manifest_epoch, manifest_generation))
+  if not entries:
+    print("AWS S3 Bucket is Empty")
+    if changed or failed != failed_configs:
+      saveSyncCache(entries, epoch, generation, failed)
+    manifest_epoch, manifest_generation, manifest_etag, failed_configs = epoch, generation, etag, failed
+    return entries, None, changed
+
+  if state is None or changed:
+    # Read the TNSR state once and work out everything that has to change from it
+    with metrics.timer('snapshot'):
+      state = TnsrState(restconf)
+  tunnels = len(state.by_endpoint)
+  with metrics.timer('plan'):
+    plan = planChanges(entries, state)
+    routes = planRoutes(entries, state, plan)
+  metrics.gauge('routes', routes)
+  with metrics.timer('apply'):
+    applied = applyChanges(plan, s3, entries)
+  for status in ('create', 'delete', 'route'):
+    planned = sum(1 for action in plan if action['status'] == status)
+    metrics.gauge('planned_' + status + 's', planned)
+    metrics.gauge('pending_' + status + 's', planned - sum(1 for action in applied if action['status'] == status))
+  metrics.gauge('tunnels', tunnels + sum(1 for action in applied if action.get('new')) -
+                sum(1 for action in applied if action['status'] == 'delete' and action['tunnel_id'] is not None))
+  if changed or plan or failed != failed_configs:
+    saveSyncCache(entries, epoch, generation, failed)
+  manifest_epoch, manifest_generation, manifest_etag, failed_configs = epoch, generation, etag, failed
+  # Applying changes makes the snapshot stale
+  return entries, (None if plan else state), bool(changed or plan)
+
+# This function writes the metrics of the runs so far to metrics_file, replacing the previous version
+def writeMetrics():
+  if not metrics_file:
+    return
+  metrics.gauge('last_run_timestamp_seconds', time.time())
+  try:
+    metrics.writeTextfile(metrics_file, 'transitvpc')
+  except (IOError, OSError) as e:
+    print("Failed to write metrics to {0}: {1}".format(metrics_file, e))
+
+def createIPSec():
+  try:
+    with metrics.timer('reconcile'):
+      reconcile(getS3(), loadSyncCache())
+  finally:
+    writeMetrics()
+
+# This function keeps running reconcile with the S3 client, config cache and TNSR snapshot kept warm. Runs are
+# interval seconds apart plus or minus jitter, the gap doubles up to max_interval while nothing changes and
+# drops back to interval as soon as something does. SIGHUP starts a run at once, SIGTERM stops the loop.
+def runDaemon(interval, max_interval, jitter):
+  wake = threading.Event()
+  stopping = []
+
+  def trigger(signum, frame):
+    wake.set()
+
+  def stop(signum, frame):
+    stopping.append(signum)
+    wake.set()
+
+  signal.signal(signal.SIGHUP, trigger)
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+
+  s3 = getS3()
+  cache = loadSyncCache()
+  state = None
+  delay = interval
+  while not stopping:
+    wake.clear()
+    if state is not None and time.time() - state.taken > snapshot_max_age:
+      state = None
+    try:
+      with metrics.timer('reconcile'):
+        cache, state, changed = reconcile(s3, cache, state)
+    except Exception:
+      traceback.print_exc()
+      metrics.count('reconcile_errors')
+      state = None
+      changed = False
+    writeMetrics()
+    delay = interval if changed else min(delay * 2, max_interval)
+    wake.wait(delay * random.uniform(1 - jitter, 1 + jitter))
+  restconf.close()
 
 if __name__ == "__main__":
-  createIPSec()
+  parser = argparse.ArgumentParser(description='Configure TNSR IPsec tunnels from the Transit VPC configs in S3.')
+  parser.add_argument('--daemon', action='store_true', help='keep running instead of doing a single run')
+  parser.add_argument('--interval', type=float, default=60, help='seconds between runs in daemon mode')
+  parser.add_argument('--max-interval', type=float, default=300, help='longest gap between runs while nothing changes')
+  parser.add_argument('--jitter', type=float, default=0.1, help='fraction by which each gap is randomised')
+  args = parser.parse_args()
+  if args.daemon:
+    runDaemon(args.interval, max(args.interval, args.max_interval), args.jitter)
+  else:
+    createIPSec()
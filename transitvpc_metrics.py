@@ -0,0 +1,146 @@
+"""Timings, counters and gauges of the poller and the TNSR agent.
+
+Both keep one Metrics object per process. Phases are timed with
+metrics.timer(name), events are counted with metrics.count(name) and levels
+are set with metrics.gauge(name, value); keyword arguments add labels, e.g.
+metrics.count('api_calls', operation='DescribeVpcs'). The poller prints the
+metrics of each invocation as CloudWatch Embedded Metric Format documents,
+the agent writes them to a Prometheus textfile after each run.
+"""
+
+import contextlib
+import os
+import re
+import threading
+import time
+
+# EMF documents may hold at most this many metrics
+EMF_MAX_METRICS = 100
+# Error codes botocore retries as throttling
+THROTTLE_CODES = ('Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+                  'TooManyRequestsException', 'RequestLimitExceeded', 'RequestThrottled', 'SlowDown',
+                  'EC2ThrottledException')
+_invalid_name = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def _key(name, labels):
+  return (name, tuple(sorted(labels.items())))
+
+
+class Metrics(object):
+  """Thread safe store of timers (count, total and longest time), counters and gauges."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.timers = {}
+      self.counters = {}
+      self.gauges = {}
+
+  @contextlib.contextmanager
+  def timer(self, name, **labels):
+    start = time.monotonic()
+    try:
+      yield
+    finally:
+      self.observe(name, time.monotonic() - start, **labels)
+
+  def observe(self, name, seconds, **labels):
+    key = _key(name, labels)
+    with self.lock:
+      count, total, longest = self.timers.get(key, (0, 0.0, 0.0))
+      self.timers[key] = (count + 1, total + seconds, max(longest, seconds))
+
+  def count(self, name, value=1, **labels):
+    key = _key(name, labels)
+    with self.lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def gauge(self, name, value, **labels):
+    with self.lock:
+      self.gauges[_key(name, labels)] = value
+
+  def instrumentClient(self, client):
+    """Count the API calls, retries and throttled attempts of a boto3 client."""
+    client.meta.events.register('after-call', self._afterCall)
+    client.meta.events.register('needs-retry', self._needsRetry)
+
+  def _afterCall(self, model, parsed, **kwargs):
+    self.count('api_calls', operation=model.name)
+    retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if retries:
+      self.count('api_retries', retries, operation=model.name)
+
+  def _needsRetry(self, response=None, operation=None, **kwargs):
+    # Called for every attempt; returning None leaves the retry decision to botocore
+    if response is not None and (response[1] or {}).get('Error', {}).get('Code') in THROTTLE_CODES:
+      self.count('api_throttles', operation=operation.name)
+
+  def snapshot(self):
+    """Return copies of the timers, counters and gauges, each keyed by (name, labels)."""
+    with self.lock:
+      return dict(self.timers), dict(self.counters), dict(self.gauges)
+
+  def emf(self, namespace, dimensions, timestamp=None):
+    """Return the metrics as CloudWatch Embedded Metric Format documents, one JSON-able dict per
+    EMF_MAX_METRICS metrics. Labels become part of the metric name; a timer becomes its count and its total and
+    longest time in milliseconds."""
+    timers, counters, gauges = self.snapshot()
+    values = []
+    for (name, labels), (count, total, longest) in sorted(timers.items()):
+      suffix = ''.join('.' + str(label) for _, label in labels)
+      values.append((name + '_count' + suffix, 'Count', count))
+      values.append((name + '_ms' + suffix, 'Milliseconds', round(total * 1000, 3)))
+      values.append((name + '_max_ms' + suffix, 'Milliseconds', round(longest * 1000, 3)))
+    for (name, labels), value in sorted(counters.items()) + sorted(gauges.items()):
+      values.append((name + ''.join('.' + str(label) for _, label in labels), 'Count', value))
+    timestamp = int((timestamp or time.time()) * 1000)
+    documents = []
+    for start in range(0, len(values), EMF_MAX_METRICS):
+      chunk = values[start:start + EMF_MAX_METRICS]
+      document = dict(dimensions)
+      document['_aws'] = {'Timestamp': timestamp, 'CloudWatchMetrics': [{
+        'Namespace': namespace,
+        'Dimensions': [sorted(dimensions)],
+        'Metrics': [{'Name': name, 'Unit': unit} for name, unit, _ in chunk],
+      }]}
+      document.update((name, value) for name, _, value in chunk)
+      documents.append(document)
+    return documents
+
+  def prometheus(self, prefix):
+    """Return the metrics in the Prometheus text exposition format with every name starting with prefix + '_':
+    timers as summaries in seconds, counters with a _total suffix."""
+    timers, counters, gauges = self.snapshot()
+    families = {}
+    for (name, labels), (count, total, longest) in timers.items():
+      family = families.setdefault((prefix + '_' + name + '_seconds', 'summary'), [])
+      family.append(('_sum', labels, total))
+      family.append(('_count', labels, count))
+    for (name, labels), value in counters.items():
+      families.setdefault((prefix + '_' + name + '_total', 'counter'), []).append(('', labels, value))
+    for (name, labels), value in gauges.items():
+      families.setdefault((prefix + '_' + name, 'gauge'), []).append(('', labels, value))
+    lines = []
+    for (name, kind), samples in sorted(families.items()):
+      name = _invalid_name.sub('_', name)
+      lines.append('# TYPE {0} {1}'.format(name, kind))
+      for suffix, labels, value in sorted(samples):
+        text = ','.join('{0}="{1}"'.format(_invalid_name.sub('_', label),
+                                           str(label_value).replace('\\', '\\\\').replace('"', '\\"'))
+                        for label, label_value in labels)
+        lines.append('{0}{1}{2} {3}'.format(name, suffix, '{' + text + '}' if text else '', float(value)))
+    return '\n'.join(lines) + '\n'
+
+  def writeTextfile(self, path, prefix):
+    """Write the metrics to path for the node_exporter textfile collector, replacing the file atomically."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    tmp_file = path + '.tmp'
+    with open(tmp_file, 'w') as f:
+      f.write(self.prometheus(prefix))
+    os.rename(tmp_file, path)
@@ -0,0 +1,96 @@
+"""The IPv4 static routes the TNSR agent wants on TNSR, kept in a binary prefix trie.
+
+The agent adds the spoke subnets of every tunnel to a RouteTable with the
+tunnel as next hop, and blocks the prefixes of the routes on TNSR it does not
+manage (e.g. the default route via the VPP interface). aggregate() then
+returns the smallest set of routes which forwards every address the same way:
+a route whose nearest covering route has the same next hop is left out, and
+two adjacent halves of a prefix with the same next hop become one route for
+the whole prefix. A blocked prefix is never replaced, covered away or merged
+into, so the routes the agent does not manage keep routing what they route.
+"""
+
+import ipaddress
+
+
+class _Blocked(object):
+  """Next hop of a route which is not managed by the agent; equal to nothing but itself."""
+
+  __slots__ = ()
+
+
+class _Node(object):
+  __slots__ = ('children', 'hop')
+
+  def __init__(self):
+    self.children = [None, None]
+    self.hop = None
+
+
+class RouteTable(object):
+  """Routes by prefix with a next hop each. Next hops are compared for equality only and must not be None."""
+
+  def __init__(self):
+    self.root = _Node()
+    self.routes = 0
+
+  def _node(self, prefix):
+    # Raises ValueError for anything but an IPv4 network written without host bits
+    network = ipaddress.IPv4Network(prefix)
+    address = int(network.network_address)
+    node = self.root
+    for depth in range(network.prefixlen):
+      bit = (address >> (31 - depth)) & 1
+      if node.children[bit] is None:
+        node.children[bit] = _Node()
+      node = node.children[bit]
+    return node
+
+  def add(self, prefix, hop):
+    """Route prefix via hop. If the prefix already has a route, it is kept and its next hop returned (None when it is
+    blocked); otherwise, or when it is the same, hop is returned."""
+    node = self._node(prefix)
+    if node.hop is None:
+      node.hop = hop
+      self.routes += 1
+    return None if isinstance(node.hop, _Blocked) else node.hop
+
+  def block(self, prefix):
+    """Mark prefix as routed by something else: it is never part of the routes aggregate() returns."""
+    node = self._node(prefix)
+    if node.hop is None:
+      self.routes += 1
+    node.hop = _Blocked()
+
+  def __len__(self):
+    return self.routes
+
+  def aggregate(self):
+    """Return the aggregated routes as a dict of prefix (e.g. '10.1.0.0/23') to next hop, without the blocked ones."""
+    routes = {}
+    hop = self._reduce(self.root, 0, 0, None, routes)
+    if hop is not None and not isinstance(hop, _Blocked):
+      routes['0.0.0.0/0'] = hop
+    return routes
+
+  def _reduce(self, node, address, depth, covering, routes):
+    # Adds the routes kept below node to routes and returns the next hop kept for node itself (or None). covering is
+    # the next hop of the nearest route above node.
+    hop = node.hop
+    inherited = hop if hop is not None else covering
+    kept = [None, None]
+    for bit, child in enumerate(node.children):
+      if child is not None:
+        kept[bit] = self._reduce(child, address | bit << (31 - depth), depth + 1, inherited, routes)
+    if hop is None and kept[0] is not None and kept[0] == kept[1] and not isinstance(kept[0], _Blocked):
+      # Both halves go the same way: one route for the whole prefix
+      hop = kept[0]
+    else:
+      for bit in (0, 1):
+        if kept[bit] is not None and not isinstance(kept[bit], _Blocked):
+          child_address = address | bit << (31 - depth)
+          routes[str(ipaddress.IPv4Network((child_address, depth + 1)))] = kept[bit]
+    if hop is not None and hop == covering:
+      # The route above already sends it the same way
+      return None
+    return hop